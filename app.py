@@ -1,12 +1,32 @@
 import os
 import tempfile
+import shutil
 import requests
 import time
 import json
-from flask import Flask, render_template, request, jsonify, send_file, url_for
-from werkzeug.utils import secure_filename
+import hashlib
+import hmac
+import secrets
+import sqlite3
+import mimetypes
+import io
+import random
+import email.utils
+import struct
+import multiprocessing
+from flask import Flask, render_template, request, jsonify, send_file, url_for, make_response, stream_with_context
+from werkzeug.utils import secure_filename, safe_join
 import uuid
-from urllib.parse import urlparse
+import threading
+import heapq
+import bisect
+import queue
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse, urlencode, quote, unquote, parse_qs
+import httpx
 from volcenginesdkarkruntime import Ark
 
 # 新增：加载 .env 环境变量
@@ -20,10 +40,12 @@ app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'outputs'
+app.config['DATA_FOLDER'] = 'data'  # 本地 SQLite 等运行时数据
 
 # 确保上传和输出文件夹存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['DATA_FOLDER'], exist_ok=True)
 
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
@@ -31,30 +53,657 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# 新增：Ark 客户端
-def get_ark_client(api_key: str) -> Ark:
-    base_url = os.environ.get("ARK_BASE_URL", "https://ark.ap-southeast.bytepluses.com/api/v3")
-    return Ark(api_key=api_key, base_url=base_url)
+# 新增：Prometheus 文本格式指标（GET /metrics）。每个指标一把锁，热路径只做一次字典查找和几次加法，
+# 直方图的桶定位在锁外完成；累计桶、磁盘占用等只在抓取时计算
+METRICS_DISK_TTL = float(os.environ.get('METRICS_DISK_TTL', '60'))  # 抓取时目录占用统计的最长复用秒数
 
-# 新增：多地域客户端候选（自动回退）
-def get_ark_clients(api_key: str):
+def _metric_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def _metric_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """单调递增计数器；inc() 的位置参数为与 labels 同序的标签值"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_metric_labels(self.labels, values)} {_metric_value(v)}" for values, v in items]
+
+class Histogram:
+    """累积直方图；buckets 为升序上界，observe() 只累加所在桶，累计值在抓取时计算"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][idx] += 1
+            series[1] += value
+
+    def lines(self):
+        with self._lock:
+            snapshot = sorted((values, list(s[0]), s[1]) for values, s in self._series.items())
+        out = []
+        bucket_labels = self.labels + ('le',)
+        for values, counts, total in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                out.append(f"{self.name}_bucket{_metric_labels(bucket_labels, values + (_metric_value(float(bound)),))} {cumulative}")
+            out.append(f"{self.name}_sum{_metric_labels(self.labels, values)} {_metric_value(total)}")
+            out.append(f"{self.name}_count{_metric_labels(self.labels, values)} {cumulative}")
+        return out
+
+class CollectedMetric:
+    """抓取时由 collect() 计算的指标（瞬时量或取自已有 stats() 的累计量）；
+    collect 返回 {标签值元组: 数值}"""
+
+    def __init__(self, name, help_text, collect, labels=(), kind='gauge'):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.kind = kind
+        self._collect = collect
+
+    def lines(self):
+        items = sorted(self._collect().items())
+        return [f"{self.name}{_metric_labels(self.labels, values)} {_metric_value(v)}" for values, v in items]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, buckets, labels=()):
+        return self.register(Histogram(name, help_text, buckets, labels))
+
+    def collected(self, name, help_text, collect, labels=(), kind='gauge'):
+        return self.register(CollectedMetric(name, help_text, collect, labels, kind))
+
+    def render(self):
+        out = []
+        for metric in self._metrics:
+            try:
+                lines = metric.lines()
+            except Exception as e:
+                print(f"Metric {metric.name} collection failed: {e}")
+                continue
+            out.append(f"# HELP {metric.name} {metric.help}")
+            out.append(f"# TYPE {metric.name} {metric.kind}")
+            out.extend(lines)
+        return '\n'.join(out) + '\n'
+
+metrics = MetricsRegistry()
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+THROUGHPUT_BUCKETS = (128 * 1024, 512 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+RENDER_BUCKETS = (15, 30, 45, 60, 90, 120, 180, 240, 300, 450, 600, 900)
+GENERATION_BUCKETS = RENDER_BUCKETS + (1200, 1800, 3600)  # 含排队、限流等待与下载
+POLL_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+metric_ingest_bytes = metrics.histogram(
+    'imagetest_upload_ingest_bytes', 'Size of uploaded images read by ingest_upload.', BYTES_BUCKETS, ('outcome',))
+metric_ingest_seconds = metrics.histogram(
+    'imagetest_upload_ingest_seconds', 'Time spent streaming, hashing and sniffing an upload.', SECONDS_BUCKETS, ('outcome',))
+metric_rehost_seconds = metrics.histogram(
+    'imagetest_rehost_upload_seconds', 'Image host upload latency per provider and outcome.', SECONDS_BUCKETS,
+    ('provider', 'outcome'))
+metric_rehost_requests = metrics.counter(
+    'imagetest_rehost_requests_total', 'rehost_image calls by how the URL was obtained.', ('source',))
+metric_ark_seconds = metrics.histogram(
+    'imagetest_ark_request_seconds', 'Ark API call latency per operation, region and status code.', SECONDS_BUCKETS,
+    ('op', 'region', 'code'))
+metric_task_updates = metrics.counter(
+    'imagetest_task_updates_total', 'Task status results applied by the poller, by source.', ('source',))
+metric_task_polls = metrics.histogram(
+    'imagetest_task_polls', 'Status polls spent per finished task.', POLL_COUNT_BUCKETS, ('status',))
+metric_render_seconds = metrics.histogram(
+    'imagetest_ark_render_seconds', 'Ark-side render time (created_at to updated_at) of succeeded tasks per model.',
+    RENDER_BUCKETS, ('model',))
+metric_generation_seconds = metrics.histogram(
+    'imagetest_generation_seconds', 'End-to-end latency from job submit to the video being ready locally, per model.',
+    GENERATION_BUCKETS, ('model',))
+metric_download_bytes = metrics.counter(
+    'imagetest_download_bytes_total', 'Bytes received while downloading generated videos.', ('outcome',))
+metric_download_seconds = metrics.histogram(
+    'imagetest_download_seconds', 'Video download duration including resumes.', SECONDS_BUCKETS + (120, 300), ('outcome',))
+metric_download_throughput = metrics.histogram(
+    'imagetest_download_throughput_bytes_per_second', 'Throughput of successful video downloads.', THROUGHPUT_BUCKETS)
+
+# 新增：进程级 Ark 客户端注册表（按 (api_key, base_url) 复用客户端及其 keep-alive 连接池）
+ARK_CLIENT_CACHE_SIZE = int(os.environ.get('ARK_CLIENT_CACHE_SIZE', '16'))
+ARK_CLIENT_IDLE_TIMEOUT = float(os.environ.get('ARK_CLIENT_IDLE_TIMEOUT', '600'))
+ARK_CLIENT_MAX_CONNECTIONS = int(os.environ.get('ARK_CLIENT_MAX_CONNECTIONS', '20'))
+
+class ArkClientRegistry:
+    """LRU + 空闲超时的客户端缓存。
+
+    lease() 借出客户端并统计在途请求数；借出时在途数已达连接池上限则记一次 pool_saturated。
+    被淘汰的客户端若仍有在途请求，会在最后一次归还时再关闭。
+    """
+
+    def __init__(self, max_size, idle_timeout, max_connections):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._max_connections = max_connections
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'pool_saturated': 0}
+
+    @contextmanager
+    def lease(self, api_key, base_url):
+        with self._lock:
+            entry = self._acquire(api_key, base_url)
+            if entry['inflight'] >= self._max_connections:
+                self._counters['pool_saturated'] += 1
+            entry['inflight'] += 1
+        try:
+            yield entry['client']
+        finally:
+            with self._lock:
+                entry['inflight'] -= 1
+                entry['last_used'] = time.time()
+                if entry['evicted'] and entry['inflight'] == 0:
+                    self._close(entry)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, size=len(self._entries),
+                        inflight=sum(e['inflight'] for e in self._entries.values()))
+
+    def _acquire(self, api_key, base_url):
+        now = time.time()
+        self._expire(now)
+        key = (api_key, base_url)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._counters['hits'] += 1
+            self._entries.move_to_end(key)
+        else:
+            self._counters['misses'] += 1
+            limits = httpx.Limits(max_connections=self._max_connections,
+                                  max_keepalive_connections=self._max_connections,
+                                  keepalive_expiry=self._idle_timeout)
+            # SDK 内置重试关闭：429 由 ark_limiter 统一退避，其他错误由地域切换/轮询重试处理
+            client = Ark(api_key=api_key, base_url=base_url, max_retries=0,
+                         http_client=httpx.Client(base_url=base_url, limits=limits, timeout=httpx.Timeout(60.0, connect=10.0)))
+            entry = {'client': client, 'inflight': 0, 'evicted': False}
+            self._entries[key] = entry
+            while len(self._entries) > self._max_size:
+                _, old = self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+                self._retire(old)
+        entry['last_used'] = now
+        return entry
+
+    def _expire(self, now):
+        # OrderedDict 按最近使用排序，只需从最旧一端检查
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry['last_used'] < self._idle_timeout or entry['inflight']:
+                break
+            self._entries.popitem(last=False)
+            self._counters['expired'] += 1
+            self._retire(entry)
+
+    def _retire(self, entry):
+        entry['evicted'] = True
+        if entry['inflight'] == 0:
+            self._close(entry)
+
+    def _close(self, entry):
+        try:
+            entry['client'].close()
+        except Exception:
+            pass
+
+ark_clients = ArkClientRegistry(ARK_CLIENT_CACHE_SIZE, ARK_CLIENT_IDLE_TIMEOUT, ARK_CLIENT_MAX_CONNECTIONS)
+
+# 新增：地域路由（按成功率/延迟 EWMA 排序，失败过多的地域熔断一段时间）
+ARK_REGIONS = [
+    "https://ark.ap-southeast.bytepluses.com/api/v3",
+    "https://ark.cn-beijing.volces.com/api/v3",
+]
+REGION_EWMA_ALPHA = 0.3
+REGION_FAILURE_THRESHOLD = int(os.environ.get('ARK_REGION_FAILURE_THRESHOLD', '3'))
+REGION_COOLDOWN = float(os.environ.get('ARK_REGION_COOLDOWN', '30'))
+REGION_PIN_LIMIT = 10000
+REGION_LATENCY_PRIOR = 5.0  # 尚无成功样本时假定的延迟（秒），避免从未成功的地域排在前面
+
+class RegionRouter:
+    """维护各地域健康度并给出尝试顺序。
+
+    - 成功/失败与延迟按 EWMA 平滑；连续失败达到阈值或成功率低于 0.5 时熔断 REGION_COOLDOWN 秒，
+      冷却结束后放行一次试探请求（半开），成功即恢复；
+    - 任务在哪个地域创建/查询成功就固定到该地域，后续轮询优先只打该地域（任务只存在于该地域，
+      即使其熔断中也保留在首位）；
+    - 新任务优先发往延迟最低的健康地域，熔断中的地域被跳过；全部熔断时才按最早恢复的顺序兜底尝试。
+    """
+
+    def __init__(self, regions):
+        self._lock = threading.Lock()
+        self._regions = list(regions)
+        self._health = {r: self._new_health() for r in regions}
+        self._pins = OrderedDict()
+
+    @staticmethod
+    def _new_health():
+        return {'latency': None, 'success': 1.0, 'samples': 0, 'failures': 0, 'open_until': 0.0, 'probing': False}
+
+    def ordered(self, task_id=None):
+        now = time.time()
+        with self._lock:
+            healthy, tripped = [], []
+            for idx, region in enumerate(self._regions):
+                h = self._health[region]
+                if h['open_until'] > now or h['probing']:
+                    tripped.append((h['open_until'], idx, region))
+                else:
+                    latency = h['latency'] if h['latency'] is not None else REGION_LATENCY_PRIOR
+                    healthy.append((latency / max(h['success'], 0.05), idx, region))
+            order = [r for _, _, r in sorted(healthy)] or [r for _, _, r in sorted(tripped)]
+            pinned = self._pins.get(task_id) if task_id else None
+        if pinned:
+            if pinned in order:
+                order.remove(pinned)
+            order.insert(0, pinned)
+        return order
+
+    def begin(self, region):
+        """请求前调用：冷却结束的熔断地域在此转为半开试探"""
+        with self._lock:
+            h = self._health.setdefault(region, self._new_health())
+            if h['open_until'] and h['open_until'] <= time.time() and not h['probing']:
+                h['probing'] = True
+
+    def abort(self, region):
+        """请求因本地异常中止、未得到地域的结果：结束半开试探，不计入成败"""
+        with self._lock:
+            h = self._health.get(region)
+            if h:
+                h['probing'] = False
+
+    def record(self, region, ok, latency):
+        with self._lock:
+            h = self._health.setdefault(region, self._new_health())
+            h['samples'] += 1
+            h['success'] = REGION_EWMA_ALPHA * (1.0 if ok else 0.0) + (1 - REGION_EWMA_ALPHA) * h['success']
+            if ok:
+                h['latency'] = latency if h['latency'] is None else REGION_EWMA_ALPHA * latency + (1 - REGION_EWMA_ALPHA) * h['latency']
+                h['failures'] = 0
+                h['open_until'] = 0.0
+                h['probing'] = False
+                return
+            h['failures'] += 1
+            if h['probing'] or h['failures'] >= REGION_FAILURE_THRESHOLD or (h['samples'] >= 5 and h['success'] < 0.5):
+                h['open_until'] = time.time() + REGION_COOLDOWN
+                h['probing'] = False
+
+    def pin(self, task_id, region):
+        with self._lock:
+            self._pins[task_id] = region
+            self._pins.move_to_end(task_id)
+            while len(self._pins) > REGION_PIN_LIMIT:
+                self._pins.popitem(last=False)
+
+    def region_of(self, task_id):
+        with self._lock:
+            return self._pins.get(task_id)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {r: {
+                'latency_ewma': h['latency'],
+                'success_ewma': round(h['success'], 3),
+                'consecutive_failures': h['failures'],
+                'circuit_open': h['open_until'] > now,
+            } for r, h in self._health.items()}
+
+region_router = RegionRouter(ARK_REGIONS)
+
+def is_region_failure(exc):
+    """只有网络层错误和 5xx 计入地域故障；4xx（含 429 限流）说明地域本身可用"""
+    return classify_error(exc).kind in ('transient', 'server')
+
+@contextmanager
+def ark_call(api_key, base_url, op='other'):
+    """借出客户端并把调用结果（延迟/成败）回报给地域路由与指标。
+    指标的 code 为 HTTP 状态码，拿不到状态码的错误（断线、超时）记为错误类别"""
+    region_router.begin(base_url)
+    region = urlparse(base_url).hostname or base_url
+    t0 = time.time()
+    try:
+        with ark_clients.lease(api_key, base_url) as client:
+            yield client
+    except Exception as e:
+        latency = time.time() - t0
+        err = classify_error(e)
+        if err.kind == 'internal':
+            region_router.abort(base_url)
+        else:
+            region_router.record(base_url, not is_region_failure(err), latency)
+        metric_ark_seconds.observe(latency, op, region, str(err.status_code) if err.status_code else err.kind)
+        raise
+    latency = time.time() - t0
+    region_router.record(base_url, True, latency)
+    metric_ark_seconds.observe(latency, op, region, '200')
+
+def get_ark_base_urls(task_id=None):
     prefer = os.environ.get("ARK_BASE_URL")
     if prefer:
-        bases = [prefer]
+        return [prefer]
+    return region_router.ordered(task_id)
+
+# 新增：上游错误分类（方舟 SDK / HTTP）。创建、查询、下载统一按类别决定是否重试：
+# auth / not_found / client / internal 不可重试，直接失败；rate_limit / transient / server 可在预算内重试
+class UpstreamError(Exception):
+    """已分类的上游错误；kind 为类别，retryable 表示重试可能成功"""
+    kind = 'unknown'
+    retryable = False
+
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class UpstreamAuthError(UpstreamError):
+    kind = 'auth'
+
+class UpstreamNotFound(UpstreamError):
+    kind = 'not_found'
+
+class UpstreamClientError(UpstreamError):
+    kind = 'client'  # 其他 4xx：参数错误、内容审核等
+
+class UpstreamRateLimited(UpstreamError):
+    kind = 'rate_limit'
+    retryable = True
+
+class UpstreamTransient(UpstreamError):
+    kind = 'transient'  # 连接失败、超时、传输中断
+    retryable = True
+
+class UpstreamServerError(UpstreamError):
+    kind = 'server'
+    retryable = True
+
+class UpstreamInternalError(UpstreamError):
+    kind = 'internal'  # 本地异常（代码错误等）：不是上游故障，不重试、不计入地域健康
+
+# 没有状态码时只有这些网络层异常视为暂时性错误（SDK 的连接/超时异常类在私有模块中，按可选导入处理）
+try:
+    from volcenginesdkarkruntime._exceptions import ArkAPIConnectionError
+except ImportError:
+    ArkAPIConnectionError = None
+
+NETWORK_ERRORS = (httpx.TransportError, requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                  requests.exceptions.ChunkedEncodingError, ConnectionError, TimeoutError)
+if ArkAPIConnectionError is not None:
+    NETWORK_ERRORS += (ArkAPIConnectionError,)
+
+def classify_error(exc, op=None):
+    """将异常归类为 UpstreamError。op='get' 时 401/403 视为任务不存在：
+    方舟查询不存在的 task_id 会返回 401 "API key doesn't exist"（见 api_key_error_analysis.md）"""
+    if isinstance(exc, UpstreamError):
+        return exc
+    status_code = getattr(exc, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(exc, 'response', None), 'status_code', None)
+    message = str(exc) or exc.__class__.__name__
+    if status_code is None:
+        if isinstance(exc, NETWORK_ERRORS + (IncompleteDownload,)):
+            return UpstreamTransient(message)
+        return UpstreamInternalError(f'{exc.__class__.__name__}: {message}')
+    if status_code in (401, 403):
+        if op == 'get':
+            return UpstreamNotFound(f'Task not found ({message})', status_code)
+        return UpstreamAuthError(message, status_code)
+    if status_code in (404, 410):
+        return UpstreamNotFound(message, status_code)
+    if status_code == 429:
+        return UpstreamRateLimited(message, status_code, retry_after_seconds(exc))
+    if status_code == 408:
+        return UpstreamTransient(message, status_code)
+    if status_code >= 500:
+        return UpstreamServerError(message, status_code)
+    return UpstreamClientError(message, status_code)
+
+# 新增：方舟调用限流与并发控制。每个 (api_key, model) 一个令牌桶限制创建请求速率，查询按 api_key 限速；
+# 同时在途（已创建未终结）的任务数超过上限时，新的创建请求排队等待名额。收到 429 时整个桶暂停到
+# Retry-After（无该头时按指数退避加抖动），在同一地域重试而不换地域——限流是账号级的
+ARK_CREATE_RATE = float(os.environ.get('ARK_CREATE_RATE', '1'))  # 每个 (api_key, model) 每秒创建请求数
+ARK_QUERY_RATE = float(os.environ.get('ARK_QUERY_RATE', '10'))  # 每个 api_key 每秒查询请求数
+ARK_RATE_BURST = float(os.environ.get('ARK_RATE_BURST', '5'))
+ARK_MAX_RUNNING_TASKS = int(os.environ.get('ARK_MAX_RUNNING_TASKS', '8'))  # 每个 (api_key, model)，0 表示不限
+ARK_LIMIT_WAIT = float(os.environ.get('ARK_LIMIT_WAIT', '300'))  # 排队最长等待秒数
+ARK_SLOT_TTL = float(os.environ.get('ARK_SLOT_TTL', '3600'))  # 未被跟踪到终态的名额最长占用时间
+ARK_429_RETRIES = int(os.environ.get('ARK_429_RETRIES', '4'))
+ARK_BACKOFF_BASE = 1.0
+ARK_BACKOFF_MAX = 60.0
+
+class ArkRateLimited(UpstreamRateLimited):
+    """排队超过 ARK_LIMIT_WAIT 仍未获得令牌或并发名额"""
+
+def retry_after_seconds(exc):
+    """从 429 响应读取 Retry-After（秒或 HTTP 日期），没有时返回 None"""
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """退避时长：有 Retry-After 时在其基础上加最多 20% 抖动，否则指数退避并取一半随机抖动"""
+    if retry_after is not None:
+        return min(ARK_BACKOFF_MAX, retry_after) * random.uniform(1.0, 1.2)
+    cap = min(ARK_BACKOFF_MAX, ARK_BACKOFF_BASE * 2 ** attempt)
+    return cap / 2 + random.uniform(0, cap / 2)
+
+class ArkLimiter:
+    """令牌桶 + 在途任务名额。键中的 api_key 只保留哈希前缀，统计输出不泄露密钥"""
+
+    def __init__(self, burst, max_running, slot_ttl):
+        self._burst = burst
+        self._max_running = max_running
+        self._slot_ttl = slot_ttl
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._slots = {}  # (key_hash, model) -> {slot_or_task_id: started_at}
+        self._slot_keys = {}
+
+    @staticmethod
+    def _key(api_key, model):
+        return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12], model or '*'
+
+    def _bucket(self, key, rate):
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = {
+                'rate': rate, 'tokens': self._burst, 'updated': time.time(), 'blocked_until': 0.0,
+                'waiting': 0, 'slot_waiting': 0, 'acquired': 0, 'throttled': 0, 'timeouts': 0,
+                'wait_total': 0.0, 'wait_max': 0.0,
+            }
+        return b
+
+    def acquire(self, api_key, model, rate, timeout=ARK_LIMIT_WAIT):
+        """取一个令牌，必要时排队等待；返回等待秒数，超时抛出 ArkRateLimited"""
+        key = self._key(api_key, model)
+        t0 = time.time()
+        deadline = t0 + timeout
+        with self._cond:
+            b = self._bucket(key, rate)
+            b['waiting'] += 1
+            try:
+                while True:
+                    now = time.time()
+                    b['tokens'] = min(self._burst, b['tokens'] + (now - b['updated']) * b['rate'])
+                    b['updated'] = now
+                    wait = b['blocked_until'] - now
+                    if wait <= 0 and b['tokens'] >= 1:
+                        b['tokens'] -= 1
+                        break
+                    if wait <= 0:
+                        wait = (1 - b['tokens']) / b['rate']
+                    if now + wait > deadline:
+                        b['timeouts'] += 1
+                        raise ArkRateLimited(f'Rate limit queue timeout after {now - t0:.1f}s ({key[1]})')
+                    self._cond.wait(wait)
+            finally:
+                b['waiting'] -= 1
+            waited = time.time() - t0
+            b['acquired'] += 1
+            b['wait_total'] += waited
+            b['wait_max'] = max(b['wait_max'], waited)
+        return waited
+
+    def throttle(self, api_key, model, delay):
+        """收到 429：该桶在 delay 秒内不再发放令牌"""
+        key = self._key(api_key, model)
+        with self._cond:
+            b = self._bucket(key, ARK_CREATE_RATE if model else ARK_QUERY_RATE)
+            b['blocked_until'] = max(b['blocked_until'], time.time() + delay)
+            b['tokens'] = 0.0
+            b['throttled'] += 1
+
+    def reserve(self, api_key, model, timeout=ARK_LIMIT_WAIT):
+        """占用一个在途任务名额，返回名额 id（创建成功后 bind 到 task_id）；超时抛出 ArkRateLimited"""
+        key = self._key(api_key, model)
+        slot_id = f'slot-{uuid.uuid4().hex}'
+        t0 = time.time()
+        with self._cond:
+            b = self._bucket(key, ARK_CREATE_RATE)
+            slots = self._slots.setdefault(key, {})
+            b['slot_waiting'] += 1
+            try:
+                while self._max_running and self._prune(slots) >= self._max_running:
+                    remaining = t0 + timeout - time.time()
+                    if remaining <= 0:
+                        b['timeouts'] += 1
+                        raise ArkRateLimited(f'Too many running tasks for {key[1]} (limit {self._max_running})')
+                    self._cond.wait(min(remaining, 5))
+            finally:
+                b['slot_waiting'] -= 1
+            slots[slot_id] = time.time()
+            self._slot_keys[slot_id] = key
+        return slot_id
+
+    def bind(self, slot_id, task_id):
+        with self._cond:
+            key = self._slot_keys.pop(slot_id, None)
+            if key is None:
+                return
+            started = self._slots[key].pop(slot_id, time.time())
+            self._slots[key][task_id] = started
+            self._slot_keys[task_id] = key
+
+    def release(self, slot_or_task_id):
+        with self._cond:
+            key = self._slot_keys.pop(slot_or_task_id, None)
+            if key is not None:
+                self._slots[key].pop(slot_or_task_id, None)
+                self._cond.notify_all()
+
+    def _prune(self, slots):
+        cutoff = time.time() - self._slot_ttl
+        for slot_id in [s for s, started in slots.items() if started < cutoff]:
+            slots.pop(slot_id, None)
+            self._slot_keys.pop(slot_id, None)
+        return len(slots)
+
+    def stats(self):
+        with self._cond:
+            return {f'{key[0]}:{key[1]}': {
+                'queue_depth': b['waiting'] + b['slot_waiting'],
+                'waiting_tokens': b['waiting'],
+                'waiting_slots': b['slot_waiting'],
+                'running_tasks': len(self._slots.get(key, {})),
+                'acquired': b['acquired'],
+                'throttled_429': b['throttled'],
+                'timeouts': b['timeouts'],
+                'avg_wait': round(b['wait_total'] / b['acquired'], 3) if b['acquired'] else 0.0,
+                'max_wait': round(b['wait_max'], 3),
+                'blocked_for': round(max(0.0, b['blocked_until'] - time.time()), 3),
+            } for key, b in self._buckets.items()}
+
+ark_limiter = ArkLimiter(ARK_RATE_BURST, ARK_MAX_RUNNING_TASKS, ARK_SLOT_TTL)
+
+class ProviderFileTooLarge(Exception):
+    """图床以 HTTP 413 拒绝文件，用于学习该图床的大小上限"""
+
+@contextmanager
+def open_upload(file_path, data=None):
+    """打开待上传文件；已在内存中的内容（data）直接包装为文件对象，不再读盘"""
+    if data is not None:
+        yield io.BytesIO(data)
     else:
-        bases = [
-            "https://ark.ap-southeast.bytepluses.com/api/v3",
-            "https://ark.cn-beijing.volces.com/api/v3",
-        ]
-    return [Ark(api_key=api_key, base_url=b) for b in bases]
+        with open(file_path, 'rb') as f:
+            yield f
 
-def upload_to_transfer_sh(file_path):
+def upload_to_transfer_sh(file_path, data=None):
     """上传文件到 transfer.sh 获取直接链接（使用 PUT 并带文件名）。"""
     try:
         filename = os.path.basename(file_path)
         url = f"https://transfer.sh/{filename}"
-        with open(file_path, 'rb') as f:
+        with open_upload(file_path, data) as f:
             resp = requests.put(url, data=f, timeout=180)
+        if resp.status_code == 413:
+            raise ProviderFileTooLarge(f"transfer.sh rejected {len(data) if data is not None else os.path.getsize(file_path)} bytes")
         if resp.status_code in (200, 201):
             link = resp.text.strip()
             if link.startswith("http"):
@@ -63,147 +712,2312 @@ def upload_to_transfer_sh(file_path):
                 print(f"Transfer.sh unexpected response: {link}")
         else:
             print(f"Transfer.sh upload failed: HTTP {resp.status_code} {resp.text}")
+    except ProviderFileTooLarge:
+        raise
     except Exception as e:
         print(f"Transfer.sh upload failed: {e}")
     return None
 
-def upload_to_catbox(file_path):
+def upload_to_catbox(file_path, data=None):
     """上传文件到catbox.moe获取直接链接"""
     try:
-        with open(file_path, 'rb') as f:
+        with open_upload(file_path, data) as f:
             response = requests.post(
                 'https://catbox.moe/user/api.php',
                 data={'reqtype': 'fileupload'},
-                files={'fileToUpload': f},
+                files={'fileToUpload': (os.path.basename(file_path), f)},
                 timeout=30
             )
+        if response.status_code == 413:
+            raise ProviderFileTooLarge(f"catbox rejected {len(data) if data is not None else os.path.getsize(file_path)} bytes")
         if response.status_code == 200:
             return response.text.strip()
+    except ProviderFileTooLarge:
+        raise
     except Exception as e:
         print(f"Catbox upload failed: {e}")
     return None
 
-def rehost_image(file_path):
-    """将本地图片重新托管到公共服务获取直接链接（优先 catbox，其次 transfer.sh，再次 0x0.st）"""
-    # 优先 catbox（在国内网络更稳定）
-    url = upload_to_catbox(file_path)
-    if url:
-        return url
-    # 尝试 transfer.sh（PUT）
-    url = upload_to_transfer_sh(file_path)
-    if url:
-        return url
-    # 尝试 0x0.st 兜底
-    url = upload_to_0x0(file_path) # type: ignore
-    if url:
-        return url
+def upload_to_0x0(file_path, data=None):
+    """上传文件到 0x0.st 获取直接链接"""
+    try:
+        with open_upload(file_path, data) as f:
+            response = requests.post('https://0x0.st', files={'file': (os.path.basename(file_path), f)}, timeout=180)
+        if response.status_code == 413:
+            raise ProviderFileTooLarge(f"0x0.st rejected {len(data) if data is not None else os.path.getsize(file_path)} bytes")
+        if response.status_code == 200:
+            link = response.text.strip()
+            if link.startswith("http"):
+                return link
+            print(f"0x0.st unexpected response: {link}")
+        else:
+            print(f"0x0.st upload failed: HTTP {response.status_code} {response.text}")
+    except ProviderFileTooLarge:
+        raise
+    except Exception as e:
+        print(f"0x0.st upload failed: {e}")
+    return None
+
+# 本地替身图床（测试/离线环境用）：复制到 uploads/local 并由本服务 /local_rehost 提供访问
+LOCAL_REHOST_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], 'local')
+LOCAL_REHOST_BASE_URL = os.environ.get('REHOST_LOCAL_BASE_URL', 'http://127.0.0.1:5000')
+
+def upload_to_local(file_path, data=None):
+    """复制文件到本地替身图床目录，返回本服务可访问的链接"""
+    os.makedirs(LOCAL_REHOST_FOLDER, exist_ok=True)
+    filename = f"{uuid.uuid4().hex}_{os.path.basename(file_path)}"
+    with open_upload(file_path, data) as src, open(os.path.join(LOCAL_REHOST_FOLDER, filename), 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    return f"{LOCAL_REHOST_BASE_URL.rstrip('/')}/local_rehost/{filename}"
+
+# 新增：签名直链。设置 PUBLIC_BASE_URL（本服务的公网地址）后，uploads/ 下的图片由本服务以
+# 短期 HMAC 签名链接直接提供给方舟拉取，跳过第三方图床
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '').rstrip('/')
+SIGNED_URL_TTL = int(os.environ.get('SIGNED_URL_TTL', '3600'))
+SIGNING_KEY_PATH = os.path.join(app.config['DATA_FOLDER'], 'signing.key')
+
+def load_signing_key():
+    """签名密钥：优先取 SIGNED_URL_SECRET，否则使用 data/signing.key（首次启动时生成，多进程共享）"""
+    secret = os.environ.get('SIGNED_URL_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    try:
+        fd = os.open(SIGNING_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(SIGNING_KEY_PATH, 'rb') as f:
+            return f.read().strip()
+    with os.fdopen(fd, 'wb') as f:
+        key = secrets.token_hex(32).encode('ascii')
+        f.write(key)
+    return key
+
+signing_key = load_signing_key()
+
+def sign_upload_path(rel_path, expires):
+    message = f"{rel_path}:{int(expires)}".encode('utf-8')
+    return hmac.new(signing_key, message, hashlib.sha256).hexdigest()
+
+def signed_upload_url(file_path, ttl=None):
+    """为 uploads/ 下的文件生成签名直链；未配置 PUBLIC_BASE_URL 或文件不在 uploads/ 下时返回 None"""
+    if not PUBLIC_BASE_URL:
+        return None
+    rel_path = os.path.relpath(os.path.abspath(file_path), os.path.abspath(app.config['UPLOAD_FOLDER']))
+    if rel_path.startswith('..') or os.path.isabs(rel_path):
+        return None
+    rel_path = rel_path.replace(os.sep, '/')
+    expires = int(time.time()) + (ttl or SIGNED_URL_TTL)
+    query = urlencode({'expires': expires, 'sig': sign_upload_path(rel_path, expires)})
+    return f"{PUBLIC_BASE_URL}/uploads/{quote(rel_path)}?{query}"
+
+def verify_signed_upload(rel_path, expires, sig):
+    """校验签名与有效期，返回剩余有效秒数；无效或已过期返回 None"""
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return None
+    remaining = expires - int(time.time())
+    if remaining <= 0 or not sig:
+        return None
+    if not hmac.compare_digest(sign_upload_path(rel_path, expires), sig):
+        return None
+    return remaining
+
+def signed_upload_file_path(url):
+    """签名有效的本服务直链 → 本地文件路径，其他链接或文件已不存在时返回 None"""
+    if not PUBLIC_BASE_URL or not url.startswith(PUBLIC_BASE_URL + '/uploads/'):
+        return None
+    parsed = urlparse(url)
+    params = parse_qs(parsed.query)
+    rel_path = unquote(parsed.path[len(urlparse(PUBLIC_BASE_URL).path) + len('/uploads/'):])
+    if verify_signed_upload(rel_path, params.get('expires', [None])[0], params.get('sig', [None])[0]) is None:
+        return None
+    file_path = safe_join(app.config['UPLOAD_FOLDER'], rel_path)
+    if not file_path or not os.path.isfile(file_path):
+        return None
+    return file_path
+
+def signed_url_digest(url):
+    """签名直链 → 图片内容哈希（供生成指纹使用），非本服务签名链接返回 None"""
+    file_path = signed_upload_file_path(url)
+    return file_sha256(file_path) if file_path else None
+
+# 新增：方舟任务回调。显式设置 ARK_CALLBACK_BASE_URL 后创建任务时附带 /callbacks/ark 回调地址
+# （不沿用 PUBLIC_BASE_URL：公网地址可用不代表回调已配置好），方舟在状态变化时主动推送，轮询降为兜底。
+# 回调地址携带由共享密钥派生的 token；也接受 X-Callback-Signature: sha256=<HMAC(密钥, 请求体)> 签名（本地替身发送器 test_callback.py 使用）
+CALLBACK_BASE_URL = os.environ.get('ARK_CALLBACK_BASE_URL', '').strip().rstrip('/')
+CALLBACK_POLL_INTERVAL = float(os.environ.get('ARK_CALLBACK_POLL_INTERVAL', '60'))  # 启用回调时的兜底轮询间隔
+CALLBACK_DEDUP_SIZE = 10000
+
+def callback_secret():
+    """回调共享密钥：优先取 ARK_CALLBACK_SECRET，否则由签名密钥派生"""
+    secret = os.environ.get('ARK_CALLBACK_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    return hmac.new(signing_key, b'ark-callback', hashlib.sha256).hexdigest().encode('ascii')
+
+def callback_token():
+    return hmac.new(callback_secret(), b'/callbacks/ark', hashlib.sha256).hexdigest()
+
+def ark_callback_url():
+    """创建任务时附带的回调地址，未配置时返回 None"""
+    if not CALLBACK_BASE_URL:
+        return None
+    return f"{CALLBACK_BASE_URL}/callbacks/ark?{urlencode({'token': callback_token()})}"
+
+def verify_callback(req, body):
+    signature = req.headers.get('X-Callback-Signature', '')
+    if signature:
+        expected = 'sha256=' + hmac.new(callback_secret(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(signature, expected)
+    return hmac.compare_digest(req.args.get('token', ''), callback_token())
+
+class CallbackDedup:
+    """已处理回调事件 (task_id, status, updated_at) 的有界记录，重复投递直接确认不再处理。
+    事件在处理成功后才 mark()，处理失败时方舟的重试不会被当作重复丢弃"""
+
+    def __init__(self, size):
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._size = size
+        self._counters = {'received': 0, 'duplicates': 0, 'rejected': 0}
+
+    def seen(self, key):
+        with self._lock:
+            self._counters['received'] += 1
+            if key in self._seen:
+                self._counters['duplicates'] += 1
+                return True
+            return False
+
+    def mark(self, key):
+        with self._lock:
+            self._seen[key] = time.time()
+            while len(self._seen) > self._size:
+                self._seen.popitem(last=False)
+
+    def reject(self):
+        with self._lock:
+            self._counters['rejected'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, enabled=bool(CALLBACK_BASE_URL))
+
+callback_dedup = CallbackDedup(CALLBACK_DEDUP_SIZE)
+
+_db_local = threading.local()
+
+def db_connect(path):
+    """当前线程到 path 的 SQLite 连接：每个线程每个库一个连接，复用而不是每次新建（随线程结束释放）。
+    配合 `with db_connect(path) as conn:` 使用，退出时提交或回滚。
+    WAL 模式（便于多线程/多进程并发读写）持久保存在库文件中，只在建表时设置一次"""
+    conns = getattr(_db_local, 'conns', None)
+    if conns is None:
+        conns = _db_local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conns[path] = conn
+    return conn
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# 新增：上传文件单次流式读取——同一遍中计算 SHA-256、嗅探魔数与尺寸并落盘，
+# 内容保留在内存中交给预处理和图床上传，不再二次读盘；非图片在任何网络请求前被拒绝
+INGEST_CHUNK_SIZE = 256 * 1024
+INGEST_MAX_PIXELS = int(os.environ.get('INGEST_MAX_PIXELS', str(40 * 1000 * 1000)))
+
+class InvalidUpload(ValueError):
+    """上传内容不是受支持的图片（魔数不符、头部损坏或像素数超限）"""
+
+class IngestedImage:
+    """单次读取得到的上传图片：内容字节、SHA-256、格式与尺寸"""
+
+    __slots__ = ('data', 'sha256', 'format', 'width', 'height')
+
+    def __init__(self, data, sha256, image_format, width, height):
+        self.data = data
+        self.sha256 = sha256
+        self.format = image_format
+        self.width = width
+        self.height = height
+
+    @property
+    def size(self):
+        return len(self.data)
+
+def sniff_image_format(head):
+    """按魔数识别图片格式，无法识别返回 None"""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def sniff_image_size(data, image_format):
+    """从文件头解析 (宽, 高)，头部损坏或截断时返回 None"""
+    try:
+        if image_format == 'png':
+            if data[12:16] != b'IHDR':
+                return None
+            return struct.unpack('>II', data[16:24])
+        if image_format == 'gif':
+            return struct.unpack('<HH', data[6:10])
+        if image_format == 'bmp':
+            width, height = struct.unpack('<ii', data[18:26])
+            return width, abs(height)
+        if image_format == 'webp':
+            chunk = data[12:16]
+            if chunk == b'VP8 ':
+                width, height = struct.unpack('<HH', data[26:30])
+                return width & 0x3fff, height & 0x3fff
+            if chunk == b'VP8L':
+                b0, b1, b2, b3 = data[21:25]
+                return 1 + (((b1 & 0x3f) << 8) | b0), 1 + (((b3 & 0x0f) << 10) | (b2 << 2) | ((b1 & 0xc0) >> 6))
+            if chunk == b'VP8X':
+                return 1 + int.from_bytes(data[24:27], 'little'), 1 + int.from_bytes(data[27:30], 'little')
+            return None
+        if image_format == 'jpeg':
+            i = 2
+            while i + 9 < len(data):
+                if data[i] != 0xff:
+                    return None
+                marker = data[i + 1]
+                if marker == 0xff:
+                    i += 1
+                    continue
+                if marker in (0x01, 0xd8) or 0xd0 <= marker <= 0xd7:
+                    i += 2
+                    continue
+                if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                    height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                    return width, height
+                i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+            return None
+    except (struct.error, ValueError):
+        return None
+    return None
+
+def inspect_image_bytes(data, sha256=None):
+    """校验内存中的图片字节并返回 IngestedImage，不是受支持的图片时抛出 InvalidUpload"""
+    image_format = sniff_image_format(data[:16])
+    if image_format is None:
+        raise InvalidUpload('unrecognized image format')
+    dimensions = sniff_image_size(data, image_format)
+    if not dimensions or dimensions[0] <= 0 or dimensions[1] <= 0:
+        raise InvalidUpload(f'corrupt {image_format} header')
+    width, height = dimensions
+    if width * height > INGEST_MAX_PIXELS:
+        raise InvalidUpload(f'image too large ({width}x{height} pixels)')
+    return IngestedImage(data, sha256 or hashlib.sha256(data).hexdigest(), image_format, width, height)
+
+def ingest_upload(file_storage, file_path):
+    """流式读取一次上传文件：边读边计算哈希并写入 file_path 的临时文件，校验通过后原子改名。
+
+    首块即检查魔数，非图片在读完整个请求体之前就被拒绝；失败时不留下任何文件。
+    """
+    h = hashlib.sha256()
+    buf = bytearray()
+    tmp_path = f"{file_path}.part"
+    t0 = time.time()
+    outcome = 'error'
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: file_storage.stream.read(INGEST_CHUNK_SIZE), b''):
+                if not buf and sniff_image_format(chunk[:16]) is None:
+                    raise InvalidUpload('unrecognized image format')
+                h.update(chunk)
+                buf += chunk
+                f.write(chunk)
+        if not buf:
+            raise InvalidUpload('empty file')
+        image = inspect_image_bytes(bytes(buf), h.hexdigest())
+        os.replace(tmp_path, file_path)
+        outcome = 'ok'
+        return image
+    except InvalidUpload as e:
+        outcome = 'rejected'
+        raise InvalidUpload(f"{file_storage.filename}: {e}") from None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        metric_ingest_bytes.observe(len(buf), outcome)
+        metric_ingest_seconds.observe(time.time() - t0, outcome)
+
+def discard_saved_files(saved_files):
+    """请求被拒绝时清理本次已落盘的上传文件"""
+    for entry in saved_files:
+        try:
+            os.remove(entry[2])
+        except OSError:
+            pass
+
+# 新增：按内容哈希缓存转存结果，相同图片不再重复上传
+DAY = 24 * 3600
+
+def provider_retention(provider, size):
+    """各图床的保留时长（秒），留出余量避免缓存返回已过期的链接"""
+    if provider == 'catbox':
+        return 90 * DAY  # catbox 官方为永久保存，这里保守取 90 天
+    if provider == 'transfer.sh':
+        return 13 * DAY  # 默认保留 14 天
+    if provider == '0x0':
+        # 0x0.st：retention = min_age + (min_age - max_age) * (size / max_size - 1) ** 3
+        min_age, max_age, max_size = 30, 365, 512 * 1024 * 1024
+        days = min_age + (min_age - max_age) * (min(size, max_size) / max_size - 1) ** 3
+        return int(days * 0.9) * DAY
+    return DAY
+
+class RehostCache:
+    """SHA-256(图片字节) → 图床链接 的持久化缓存（SQLite）"""
+
+    def __init__(self, path):
+        self._path = path
+        self._counters = {'hits': 0, 'misses': 0, 'stores': 0}
+        with db_connect(self._path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rehost_cache ('
+                ' sha256 TEXT PRIMARY KEY, url TEXT NOT NULL, provider TEXT NOT NULL,'
+                ' size INTEGER, created_at REAL NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_rehost_cache_url ON rehost_cache (url)')
+
+    def get(self, sha256):
+        with db_connect(self._path) as conn:
+            row = conn.execute(
+                'SELECT url FROM rehost_cache WHERE sha256 = ? AND expires_at > ?', (sha256, time.time())
+            ).fetchone()
+        self._counters['hits' if row else 'misses'] += 1
+        return row['url'] if row else None
+
+    def put(self, sha256, url, provider, size):
+        now = time.time()
+        retention = provider_registry.retention(provider, size)
+        with db_connect(self._path) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO rehost_cache (sha256, url, provider, size, created_at, expires_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (sha256, url, provider, size, now, now + retention),
+            )
+        self._counters['stores'] += 1
+
+    def digest_for_url(self, url):
+        """按托管链接反查图片内容哈希，未知链接返回 None"""
+        with db_connect(self._path) as conn:
+            row = conn.execute('SELECT sha256 FROM rehost_cache WHERE url = ?', (url,)).fetchone()
+        return row['sha256'] if row else None
+
+    def stats(self):
+        return dict(self._counters)
+
+rehost_cache = RehostCache(os.path.join(app.config['DATA_FOLDER'], 'rehost_cache.sqlite3'))
+
+# 新增：图床对冲上传（hedged）。未设置 REHOST_HEDGE_DELAY 时按顺序降级；
+# 设置为 0 时同时向所有图床上传；大于 0 时首选图床超过该秒数仍未返回即启动下一个
+REHOST_HEDGE_DELAY = os.environ.get('REHOST_HEDGE_DELAY')
+
+# 新增：可插拔图床注册表，按学习到的成功率 / p95 延迟 / 大小上限动态排序，连续失败的图床熔断
+REHOST_PROVIDER_FAILURES = int(os.environ.get('REHOST_PROVIDER_FAILURES', '3'))
+REHOST_PROVIDER_COOLDOWN = float(os.environ.get('REHOST_PROVIDER_COOLDOWN', '120'))
+REHOST_EWMA_ALPHA = 0.2
+REHOST_LATENCY_PRIOR = 10.0  # 尚无成功样本时假定的 p95 延迟（秒），避免持续失败的图床排在前面
+
+class ProviderRegistry:
+    """图床注册表。
+
+    register() 登记 upload(file_path, data=None) -> url|None 函数（data 为已在内存中的文件内容）及已知大小上限、保留时长；
+    ordered(size) 返回当前可用图床，按 p95 延迟 / 成功率 升序排列（无成功样本时取 REHOST_LATENCY_PRIOR），
+    跳过熔断中或大小上限不足的图床。收到 413 时将上限收紧到本次文件大小以下。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers = OrderedDict()
+
+    def register(self, name, upload, max_bytes=None, retention=None):
+        with self._lock:
+            self._providers[name] = {
+                'upload': upload,
+                'max_bytes': max_bytes,
+                'retention': retention,
+                'success': 1.0,
+                'latencies': deque(maxlen=50),
+                'attempts': 0,
+                'successes': 0,
+                'wins': 0,
+                'failures': 0,
+                'open_until': 0.0,
+            }
+
+    def unregister(self, name):
+        with self._lock:
+            self._providers.pop(name, None)
+
+    def ordered(self, size=None):
+        now = time.time()
+        with self._lock:
+            candidates = []
+            for idx, (name, p) in enumerate(self._providers.items()):
+                if p['open_until'] > now:
+                    continue
+                if size is not None and p['max_bytes'] is not None and size > p['max_bytes']:
+                    continue
+                candidates.append((self._p95(p) / max(p['success'], 0.05), idx, name, p['upload']))
+            if not candidates:
+                # 全部熔断时仍按登记顺序兜底尝试
+                candidates = [(0, idx, name, p['upload']) for idx, (name, p) in enumerate(self._providers.items())
+                              if size is None or p['max_bytes'] is None or size <= p['max_bytes']]
+        return [(name, upload) for _, _, name, upload in sorted(candidates)]
+
+    def record(self, name, ok, latency, size=None, too_large=False):
+        with self._lock:
+            p = self._providers.get(name)
+            if p is None:
+                return
+            p['attempts'] += 1
+            if too_large and size:
+                # 文件过大不代表图床不健康，只收紧大小上限
+                p['max_bytes'] = min(p['max_bytes'] or size, size - 1)
+                return
+            p['success'] = REHOST_EWMA_ALPHA * (1.0 if ok else 0.0) + (1 - REHOST_EWMA_ALPHA) * p['success']
+            if ok:
+                p['successes'] += 1
+                p['latencies'].append(latency)
+                p['failures'] = 0
+                p['open_until'] = 0.0
+            else:
+                p['failures'] += 1
+                if p['failures'] >= REHOST_PROVIDER_FAILURES:
+                    p['open_until'] = time.time() + REHOST_PROVIDER_COOLDOWN
+
+    def win(self, name):
+        with self._lock:
+            if name in self._providers:
+                self._providers[name]['wins'] += 1
+
+    def retention(self, name, size):
+        with self._lock:
+            p = self._providers.get(name)
+            fn = p['retention'] if p else None
+        return fn(size) if fn else provider_retention(name, size)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {name: {
+                'attempts': p['attempts'],
+                'successes': p['successes'],
+                'wins': p['wins'],
+                'success_ewma': round(p['success'], 3),
+                'p95_latency': round(self._p95(p), 3) if p['latencies'] else None,
+                'max_bytes': p['max_bytes'],
+                'circuit_open': p['open_until'] > now,
+            } for name, p in self._providers.items()}
+
+    @staticmethod
+    def _p95(p):
+        if not p['latencies']:
+            return REHOST_LATENCY_PRIOR
+        ordered = sorted(p['latencies'])
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+provider_registry = ProviderRegistry()
+hedge_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('REHOST_HEDGE_WORKERS', '12')), thread_name_prefix='rehost-hedge')
+
+# 内置图床；REHOST_PROVIDERS 可指定启用的图床及初始顺序（如 "local" 仅使用本地替身）
+BUILTIN_PROVIDERS = {
+    'catbox': (lambda p, data=None: upload_to_catbox(p, data), 200 * 1024 * 1024),
+    'transfer.sh': (lambda p, data=None: upload_to_transfer_sh(p, data), 10 * 1024 * 1024 * 1024),
+    '0x0': (lambda p, data=None: upload_to_0x0(p, data), 512 * 1024 * 1024),
+    'local': (lambda p, data=None: upload_to_local(p, data), None),
+}
+for _name in [n.strip() for n in os.environ.get('REHOST_PROVIDERS', 'catbox,transfer.sh,0x0').split(',') if n.strip()]:
+    if _name in BUILTIN_PROVIDERS:
+        provider_registry.register(_name, *BUILTIN_PROVIDERS[_name])
+
+def hedged_upload(file_path, providers, hedge_delay=None, data=None):
+    """按顺序启动各图床上传，返回第一个有效结果 (provider, url)，全部失败返回 (None, None)。
+
+    data 为已在内存中的文件内容时各图床直接从内存上传，不再读取 file_path。
+
+    hedge_delay 为 None 时等待当前图床结束（失败）后才启动下一个；否则当前图床超过
+    hedge_delay 秒未返回也会启动下一个。胜出后尚未开始的尝试被取消，已在途的请求
+    无法中断，其结果直接丢弃。
+    """
+    results = queue.Queue()
+    cancelled = threading.Event()
+    size = len(data) if data is not None else os.path.getsize(file_path)
+
+    def attempt(name, upload):
+        if cancelled.is_set():
+            return
+        t0 = time.time()
+        too_large = False
+        try:
+            url = upload(file_path) if data is None else upload(file_path, data)
+        except ProviderFileTooLarge as e:
+            print(f"{name} upload rejected: {e}")
+            url, too_large = None, True
+        except Exception as e:
+            print(f"{name} upload failed: {e}")
+            url = None
+        ok = bool(url) and url.startswith('http')
+        latency = time.time() - t0
+        provider_registry.record(name, ok, latency, size=size, too_large=too_large)
+        metric_rehost_seconds.observe(latency, name, 'ok' if ok else 'too_large' if too_large else 'failed')
+        results.put((name, url if ok else None))
+
+    futures = []
+    outstanding = 0
+    next_idx = 0
+    while next_idx < len(providers) or outstanding:
+        if next_idx < len(providers) and (outstanding == 0 or hedge_delay == 0):
+            futures.append(hedge_executor.submit(attempt, *providers[next_idx]))
+            next_idx += 1
+            outstanding += 1
+            continue
+        wait = hedge_delay if next_idx < len(providers) else None
+        try:
+            name, url = results.get(timeout=wait)
+        except queue.Empty:
+            # 对冲：当前图床迟迟未返回，追加启动下一个
+            futures.append(hedge_executor.submit(attempt, *providers[next_idx]))
+            next_idx += 1
+            outstanding += 1
+            continue
+        outstanding -= 1
+        if url:
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            provider_registry.win(name)
+            return name, url
+    return None, None
+
+def rehost_image(file_path, hedge_delay=None, image=None):
+    """将本地图片重新托管到公共服务获取直接链接（图床顺序由 provider_registry 动态决定）
+
+    以图片内容 SHA-256 查询缓存，命中且未过期时直接返回已托管链接，不发起任何网络请求。
+    hedge_delay 默认取 REHOST_HEDGE_DELAY。传入 image（IngestedImage）时复用其哈希与内存内容，不再读盘。
+    配置了 PUBLIC_BASE_URL 时直接返回本服务的签名直链，不上传第三方图床。
+    """
+    signed = signed_upload_url(file_path)
+    if signed:
+        metric_rehost_requests.inc('signed')
+        return signed
+    digest = image.sha256 if image is not None else file_sha256(file_path)
+    cached = rehost_cache.get(digest)
+    if cached:
+        metric_rehost_requests.inc('cache')
+        return cached
+    if hedge_delay is None and REHOST_HEDGE_DELAY not in (None, ''):
+        hedge_delay = float(REHOST_HEDGE_DELAY)
+    size = image.size if image is not None else os.path.getsize(file_path)
+    provider, url = hedged_upload(file_path, provider_registry.ordered(size), hedge_delay,
+                                  data=image.data if image is not None else None)
+    if url:
+        rehost_cache.put(digest, url, provider, size)
+    metric_rehost_requests.inc('upload' if url else 'failed')
+    return url
+
+# 新增：上传图片预处理（纠正 EXIF 方向、缩小、去除元数据、重新编码为 JPEG）。首尾帧/参考图在生成时
+# 按请求的 --ratio 裁剪后才转存，上传路由不转存（上传请求不携带 ratio，裁剪会产生新的内容哈希，上传时
+# 转存的图片不会被用到）；/generate 收到的是 /upload 已转存的链接，原样交给方舟。在进程池中执行避免占用 GIL，
+# 进程池使用 spawn：本进程有多个后台线程，fork 出的子进程可能继承被持有的锁
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+PREPROCESS_IMAGES = os.environ.get('PREPROCESS_IMAGES', 'true').lower() in ('1', 'true', 'yes')
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', '2'))
+PREPROCESS_MAX_EDGE = int(os.environ.get('PREPROCESS_MAX_EDGE', '1920'))
+PREPROCESS_QUALITY = int(os.environ.get('PREPROCESS_QUALITY', '90'))
+DEFAULT_RATIO = '1092x1080'
+_preprocess_pool = None
+_preprocess_pool_lock = threading.Lock()
+
+def parse_target_size(ratio):
+    """'1092x1080' → (1092, 1080)；'16:9' → 长边 1280 的尺寸；无法解析（如 adaptive）返回 None"""
+    ratio = str(ratio or '').strip().lower()
+    for sep in ('x', '*'):
+        if sep in ratio:
+            w, _, h = ratio.partition(sep)
+            if w.isdigit() and h.isdigit() and int(w) > 0 and int(h) > 0:
+                return int(w), int(h)
+    if ':' in ratio:
+        w, _, h = ratio.partition(':')
+        try:
+            w, h = float(w), float(h)
+        except ValueError:
+            return None
+        if w > 0 and h > 0:
+            scale = 1280 / max(w, h)
+            return max(1, round(w * scale)), max(1, round(h * scale))
+    return None
+
+def preprocess_image_bytes(data, target_size=None, max_edge=PREPROCESS_MAX_EDGE, quality=PREPROCESS_QUALITY):
+    """在子进程中运行：解码 → 纠正方向 → 裁剪到目标比例并缩小（不放大）→ 去除元数据重新编码，返回 JPEG 字节"""
+    with Image.open(io.BytesIO(data)) as im:
+        im.seek(0)
+        im = ImageOps.exif_transpose(im)
+        if im.mode in ('RGBA', 'LA', 'P'):
+            im = im.convert('RGBA')
+            background = Image.new('RGB', im.size, (255, 255, 255))
+            background.paste(im, mask=im.split()[-1])
+            im = background
+        elif im.mode != 'RGB':
+            im = im.convert('RGB')
+        if target_size:
+            tw, th = target_size
+            # 在不放大的前提下按目标比例居中裁剪
+            scale = min(1.0, im.width / tw, im.height / th)
+            im = ImageOps.fit(im, (max(1, round(tw * scale)), max(1, round(th * scale))), Image.LANCZOS)
+        if max(im.size) > max_edge:
+            im.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        out = io.BytesIO()
+        im.save(out, format='JPEG', quality=quality, optimize=True, progressive=True)
+        return out.getvalue()
+
+def _get_preprocess_pool():
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if _preprocess_pool is None:
+            _preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS,
+                                                   mp_context=multiprocessing.get_context('spawn'))
+        return _preprocess_pool
+
+def run_preprocess(jobs, timeout=60):
+    """在进程池中并行执行 preprocess_image_bytes(*args)，返回与 jobs 顺序一致的结果（失败项为异常对象）。
+    工作进程异常退出（如解码大图时内存不足被杀）会使整个池不可用：丢弃该池，提交失败时换新池重试一次"""
+    for attempt in range(2):
+        pool = _get_preprocess_pool()
+        try:
+            futures = [pool.submit(preprocess_image_bytes, *args) for args in jobs]
+            break
+        except BrokenProcessPool as e:
+            _discard_preprocess_pool(pool)
+            if attempt:
+                return [e] * len(jobs)
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result(timeout=timeout))
+        except BrokenProcessPool as e:
+            _discard_preprocess_pool(pool)
+            results.append(e)
+        except Exception as e:
+            results.append(e)
+    return results
+
+def _discard_preprocess_pool(pool):
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if _preprocess_pool is pool:
+            _preprocess_pool = None
+    pool.shutdown(wait=False)
+
+def preprocess_saved_files(saved_files):
+    """预处理已保存的上传文件 [(type, filename, path, image), ...]（不裁剪），处理后的文件以 .jpg 替换原文件；
+    直接使用 ingest 时保留在内存中的内容，解码失败或未启用预处理时保持原文件不变"""
+    if not PREPROCESS_IMAGES or Image is None or not saved_files:
+        return saved_files
+    results = run_preprocess([(image.data,) for _, _, _, image in saved_files])
+    processed = []
+    for (file_type, filename, file_path, image), data in zip(saved_files, results):
+        try:
+            if isinstance(data, Exception):
+                raise data
+            new_image = inspect_image_bytes(data)
+        except Exception as e:
+            print(f"Image preprocessing failed for {filename}: {e}")
+            processed.append((file_type, filename, file_path, image))
+            continue
+        new_filename = os.path.splitext(filename)[0] + '.jpg'
+        new_path = os.path.join(os.path.dirname(file_path), new_filename)
+        with open(new_path, 'wb') as f:
+            f.write(data)
+        if new_path != file_path:
+            os.remove(file_path)
+        processed.append((file_type, new_filename, new_path, new_image))
+    return processed
+
+def crop_to_ratio(paths, ratio):
+    """生成时按本次请求的 ratio 居中裁剪上传图片，返回与输入顺序一致的路径列表。
+    裁剪结果以 <原名>.<宽>x<高>.jpg 保存在原图旁，同一图片同一尺寸只处理一次；
+    ratio 无法解析（如 adaptive）、未启用预处理或处理失败时使用原图"""
+    target_size = parse_target_size(ratio)
+    if not PREPROCESS_IMAGES or Image is None or not target_size:
+        return list(paths)
+    suffix = f'.{target_size[0]}x{target_size[1]}.jpg'
+    results = list(paths)
+    pending = []
+    for i, path in enumerate(paths):
+        out_path = os.path.splitext(path)[0] + suffix
+        if os.path.isfile(out_path):
+            results[i] = out_path
+            continue
+        with open(path, 'rb') as f:
+            pending.append((i, out_path, (f.read(), target_size)))
+    for (i, out_path, _), data in zip(pending, run_preprocess([args for _, _, args in pending])):
+        if isinstance(data, Exception):
+            print(f"Image crop failed for {paths[i]}: {data}")
+            continue
+        with open(f"{out_path}.part", 'wb') as f:
+            f.write(data)
+        os.replace(f"{out_path}.part", out_path)
+        results[i] = out_path
+    return results
+
+# 新增：多张图片并行转存（有界线程池，结果保持原顺序）
+REHOST_WORKERS = int(os.environ.get('REHOST_WORKERS', '4'))
+rehost_executor = ThreadPoolExecutor(max_workers=REHOST_WORKERS, thread_name_prefix='rehost')
+
+def rehost_images(file_paths, images=None):
+    """并行转存多张图片，返回与输入顺序一致的链接列表（失败项为 None），耗时取决于最慢的一张。
+    images 为对应的 IngestedImage 列表时直接从内存上传"""
+    images = images or [None] * len(file_paths)
+    if len(file_paths) <= 1:
+        return [rehost_image(p, image=im) for p, im in zip(file_paths, images)]
+    return list(rehost_executor.map(lambda p, im: rehost_image(p, image=im), file_paths, images))
+
+def saved_file_entries(saved_files):
+    """已保存上传文件 [(type, filename, path, image), ...] 的描述（不含链接）"""
+    return [{
+        'type': file_type,
+        'filename': filename,
+        'path': file_path,
+        'width': image.width,
+        'height': image.height,
+    } for file_type, filename, file_path, image in saved_files]
+
+def rehost_saved_files(saved_files):
+    """转存已保存的上传文件 [(type, filename, path, image), ...]，返回 (uploaded_files, image_urls)"""
+    uploaded_files = []
+    image_urls = []
+    urls = rehost_images([path for _, _, path, _ in saved_files], [image for _, _, _, image in saved_files])
+    for entry, rehosted_url in zip(saved_file_entries(saved_files), urls):
+        if rehosted_url:
+            image_urls.append(rehosted_url)
+            uploaded_files.append(dict(entry, url=rehosted_url))
+    return uploaded_files, image_urls
+
+# 新增：上传批次索引。每次上传登记为 upload_id → 文件列表（内存 LRU + SQLite 持久化），
+# 生成路由按 upload_id 直接取图，不再扫描并排序整个上传目录
+UPLOAD_INDEX_CACHE_SIZE = int(os.environ.get('UPLOAD_INDEX_CACHE_SIZE', '1024'))
+UPLOAD_ID_CHARS = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_')
+
+def valid_upload_id(upload_id):
+    return bool(upload_id) and len(upload_id) <= 64 and set(upload_id) <= UPLOAD_ID_CHARS
+
+class UploadIndex:
+    """upload_id（客户端会话或上传批次）→ 本次保存的文件 [{'type', 'filename', 'path', 'sha256'}, ...]。
+
+    同一 upload_id 再次上传时，新文件替换同类型（如 last_frame）的旧文件，其余保留；
+    latest(kind) 返回该类上传中最近一次的批次，兼容未携带 upload_id 的旧客户端；
+    多个工作进程共用同一 SQLite，最近一次以数据库为准（按 (kind, updated_at) 索引查询）。
+    """
+
+    def __init__(self, path, capacity=UPLOAD_INDEX_CACHE_SIZE):
+        self._path = path
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._counters = {'records': 0, 'hits': 0, 'db_hits': 0, 'misses': 0}
+        with db_connect(self._path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                ' upload_id TEXT PRIMARY KEY, kind TEXT NOT NULL, files TEXT NOT NULL,'
+                ' created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_uploads_kind_updated ON uploads (kind, updated_at)')
+
+    def record(self, kind, files, upload_id=None):
+        """登记一次上传，返回 upload_id"""
+        existing = self.get(upload_id, kind) if upload_id else None
+        upload_id = upload_id or uuid.uuid4().hex
+        if existing:
+            new_types = {f['type'] for f in files}
+            files = [f for f in existing['files'] if f['type'] not in new_types] + list(files)
+        now = time.time()
+        entry = {
+            'upload_id': upload_id,
+            'kind': kind,
+            'files': files,
+            'created_at': existing['created_at'] if existing else now,
+            'updated_at': now,
+        }
+        with db_connect(self._path) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO uploads (upload_id, kind, files, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (upload_id, kind, json.dumps(files, ensure_ascii=False), entry['created_at'], now),
+            )
+        with self._lock:
+            self._remember(entry)
+            self._counters['records'] += 1
+        return upload_id
+
+    def get(self, upload_id, kind=None):
+        """按 upload_id 取批次（kind 不符视为不存在），未知返回 None"""
+        with self._lock:
+            entry = self._cache.get(upload_id)
+            if entry is not None:
+                self._cache.move_to_end(upload_id)
+                self._counters['hits'] += 1
+        if entry is None:
+            with db_connect(self._path) as conn:
+                row = conn.execute('SELECT * FROM uploads WHERE upload_id = ?', (upload_id,)).fetchone()
+            with self._lock:
+                if row is None:
+                    self._counters['misses'] += 1
+                    return None
+                entry = dict(row)
+                entry['files'] = json.loads(entry['files'])
+                self._remember(entry)
+                self._counters['db_hits'] += 1
+        if kind and entry['kind'] != kind:
+            return None
+        return entry
+
+    def latest(self, kind):
+        with db_connect(self._path) as conn:
+            row = conn.execute(
+                'SELECT * FROM uploads WHERE kind = ? ORDER BY updated_at DESC LIMIT 1', (kind,)
+            ).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry['files'] = json.loads(entry['files'])
+        with self._lock:
+            self._remember(entry)
+            self._counters['db_hits'] += 1
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, cached=len(self._cache))
+
+    def _remember(self, entry):
+        self._cache[entry['upload_id']] = entry
+        self._cache.move_to_end(entry['upload_id'])
+        while len(self._cache) > self._capacity:
+            self._cache.popitem(last=False)
+
+upload_index = UploadIndex(os.path.join(app.config['DATA_FOLDER'], 'uploads.sqlite3'))
+
+def record_saved_files(kind, saved_files, upload_id=None):
+    """将本次保存的上传文件 [(type, filename, path, image), ...] 登记到上传索引，返回 upload_id"""
+    return upload_index.record(kind, [
+        {'type': file_type, 'filename': filename, 'path': file_path, 'sha256': image.sha256}
+        for file_type, filename, file_path, image in saved_files
+    ], upload_id)
+
+def resolve_upload_paths(kind, upload_id=None, types=None, limit=None):
+    """按 upload_id（缺省取该类最近一次上传）解析出仍存在的图片路径，按 types 顺序排列。
+    返回 (paths, error)，upload_id 未知时 error 为错误信息"""
+    entry = upload_index.get(upload_id, kind) if upload_id else upload_index.latest(kind)
+    if entry is None:
+        return [], (f'Unknown upload_id: {upload_id}' if upload_id else None)
+    files = [f for f in entry['files'] if os.path.isfile(f['path'])]
+    if types:
+        files = [f for t in types for f in files if f['type'] == t]
+    paths = [f['path'] for f in files]
+    return (paths[-limit:] if limit else paths), None
+
+def _request_upload_id():
+    """从 JSON 体、表单或查询参数读取 upload_id"""
+    data = request.get_json(silent=True) or {}
+    return data.get('upload_id') or request.form.get('upload_id') or request.args.get('upload_id')
+
+def create_video_task(api_key, model_name, image_urls, **kwargs):
+    """使用方舟SDK创建参考图生视频任务，返回 {"id": task_id, "region", "callback"} 或 {"error": ...} """
+    try:
+        # 构建包含视频参数的prompt
+        base_prompt = kwargs.get('prompt', 'Generate a video based on the provided images')
+        ratio = kwargs.get('ratio', '1092x1080')
+        duration = int(kwargs.get('duration', 5))
+        fps = int(kwargs.get('fps', 24))
+        watermark = 'false' if not kwargs.get('watermark', False) else 'true'
+        seed = int(kwargs.get('seed', -1))
+        temperature = float(kwargs.get('temperature', 0.7))
+        
+        # 按照方舟API格式添加参数到prompt
+        full_prompt = f"{base_prompt} --ratio {ratio} --dur {duration} --fps {fps} --wm {watermark}"
+        if seed != -1:
+            full_prompt += f" --seed {seed}"
+        if temperature != 0.7:
+            full_prompt += f" --temperature {temperature}"
+        
+        content = [
+            {
+                "type": "text",
+                "text": full_prompt
+            }
+        ]
+        for url in image_urls:
+            content.append({
+                "type": "image_url",
+                "image_url": {"url": url},
+                "role": "reference_image",
+            })
+        model_id = model_name or "seedance-1-0-lite-i2v-250428"
+
+        # 配置了回调地址时方舟在任务状态变化时主动通知 /callbacks/ark
+        create_kwargs = {}
+        callback_url = ark_callback_url()
+        if callback_url:
+            create_kwargs['callback_url'] = callback_url
+
+        # 在途任务达到上限时在此排队；名额在任务终结时由 job_manager 释放
+        slot = ark_limiter.reserve(api_key, model_id)
+        try:
+            last_err = None
+            throttled = 0
+            base_urls = get_ark_base_urls()
+            idx = 0
+            while idx < len(base_urls):
+                base_url = base_urls[idx]
+                ark_limiter.acquire(api_key, model_id, ARK_CREATE_RATE)
+                try:
+                    with ark_call(api_key, base_url, op='create') as client:
+                        create_result = client.content_generation.tasks.create(
+                            model=model_id,
+                            content=content,
+                            **create_kwargs,
+                        )
+                except Exception as e:
+                    last_err = classify_error(e)
+                    if last_err.kind == 'rate_limit':
+                        if throttled >= ARK_429_RETRIES:
+                            return {"error": f"Rate limited by Ark after {throttled} retries: {e}", "error_kind": last_err.kind}
+                        # 限流：暂停该桶后在同一地域重试
+                        ark_limiter.throttle(api_key, model_id, backoff_delay(throttled, last_err.retry_after))
+                        throttled += 1
+                        continue
+                    if last_err.kind in ('client', 'internal'):
+                        # 请求本身有误（参数、内容审核等）或本地异常，换地域也不会成功
+                        return {"error": f"Create task rejected: {e}", "error_kind": last_err.kind}
+                    # auth：不同地域的 API Key 互不通用，继续尝试其他地域；transient / server：地域故障切换
+                    idx += 1
+                    continue
+                task_id = None
+                if isinstance(create_result, dict):
+                    task_id = create_result.get('id') or create_result.get('task_id') or create_result.get('result', {}).get('id')
+                else:
+                    try:
+                        data = json.loads(create_result.model_dump_json())
+                        task_id = data.get('id') or data.get('task_id') or data.get('result', {}).get('id')
+                    except Exception:
+                        task_id = getattr(create_result, 'id', None)
+                if task_id:
+                    # 后续轮询固定到创建任务的地域
+                    region_router.pin(task_id, base_url)
+                    ark_limiter.bind(slot, task_id)
+                    slot = None
+                    return {"id": task_id, "region": base_url, "callback": bool(callback_url)}
+                idx += 1
+            return {"error": f"Create task failed on all base_urls: {last_err}",
+                    "error_kind": last_err.kind if last_err else 'unknown'}
+        finally:
+            if slot:
+                ark_limiter.release(slot)
+    except Exception as e:
+        return {"error": str(e), "error_kind": e.kind if isinstance(e, UpstreamError) else 'unknown'}
+
+def fetch_task(api_key, task_id):
+    """查询一次任务状态（按地域依次尝试，取第一个成功响应），失败时抛出 UpstreamError。
+
+    已知任务所在地域时，not_found / auth / client 错误直接抛出；未知时其他地域可能持有该任务，
+    全部地域都失败后才抛出。
+    """
+    last_err = None
+    pinned = region_router.region_of(task_id)
+    for base_url in get_ark_base_urls(task_id):
+        ark_limiter.acquire(api_key, None, ARK_QUERY_RATE)
+        try:
+            with ark_call(api_key, base_url, op='get') as client:
+                result = client.content_generation.tasks.get(task_id=task_id)
+        except Exception as e:
+            last_err = classify_error(e, op='get')
+            if last_err.kind == 'rate_limit':
+                # 限流不换地域：暂停查询桶，由调用方（轮询器）按其间隔稍后重试
+                ark_limiter.throttle(api_key, None, backoff_delay(0, last_err.retry_after))
+                raise last_err
+            if last_err.kind == 'internal':
+                raise  # 本地异常原样抛出，不再尝试其他地域
+            if not last_err.retryable and pinned == base_url:
+                raise last_err
+            continue
+        if region_router.region_of(task_id) != base_url:
+            region_router.pin(task_id, base_url)
+        if isinstance(result, dict):
+            return result
+        try:
+            return json.loads(result.model_dump_json())
+        except Exception:
+            return {
+                "status": getattr(result, 'status', None),
+                "content": getattr(result, 'content', None),
+                "result": getattr(result, 'result', None),
+            }
+    raise last_err or UpstreamTransient('No Ark client available')
+
+# 新增：流式下载参数（分块大小、断线续传次数）
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_MAX_RESUMES = int(os.environ.get('DOWNLOAD_MAX_RESUMES', '5'))
+
+class IncompleteDownload(Exception):
+    pass
+
+def _content_total(response, offset):
+    """从 Content-Range（206）或 Content-Length（200）推算文件总大小，无法确定时返回 None"""
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and not response.headers.get('Content-Encoding'):
+        return offset + int(length)
+    return None
+
+def download_video(video_url, output_path):
+    """下载生成的视频：流式分块写入同目录临时文件，断线后用 HTTP Range 续传，
+    校验 Content-Length 后原子替换到 output_path，内存占用与视频大小无关。"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or '.', prefix='.dl_', suffix='.part')
+    t0 = time.time()
+    received = 0
+    try:
+        expected = None
+        written = 0
+        resumes = 0
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                headers = {'Range': f'bytes={written}-'} if written else {}
+                try:
+                    # (连接超时, 两次读之间的超时)：大文件不再受总时长限制
+                    with requests.get(video_url, stream=True, timeout=(10, 60), headers=headers) as response:
+                        response.raise_for_status()
+                        if written and response.status_code != 206:
+                            # 服务端不支持续传，从头重新写
+                            f.seek(0)
+                            f.truncate()
+                            written = 0
+                        expected = _content_total(response, written) or expected
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            if chunk:
+                                f.write(chunk)
+                                written += len(chunk)
+                                received += len(chunk)
+                    if expected is not None and written < expected:
+                        raise IncompleteDownload(f'{written}/{expected} bytes')
+                    break
+                except Exception as e:
+                    # 404/403 等（链接过期）不可重试直接失败；断线、超时、5xx、429 在预算内续传
+                    err = classify_error(e)
+                    resumes += 1
+                    if not err.retryable or resumes > DOWNLOAD_MAX_RESUMES:
+                        raise err
+                    print(f"Video download interrupted at {written} bytes ({err.kind}: {e}), resuming")
+                    time.sleep(err.retry_after if err.retry_after is not None else min(2 ** resumes, 10))
+            f.flush()
+            os.fsync(f.fileno())
+        if written == 0 or (expected is not None and written != expected):
+            raise IncompleteDownload(f'{written}/{expected} bytes')
+        os.replace(tmp_path, output_path)
+        elapsed = time.time() - t0
+        metric_download_bytes.inc('ok', amount=received)
+        metric_download_seconds.observe(elapsed, 'ok')
+        if elapsed > 0:
+            metric_download_throughput.observe(received / elapsed)
+        return True
+    except Exception as e:
+        print(f"Video download failed: {e}")
+        metric_download_bytes.inc('failed', amount=received)
+        metric_download_seconds.observe(time.time() - t0, 'failed')
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+def _extract_result(result):
+    """兼容不同SDK返回结构，提取 (status, video_url)"""
+    result = result or {}
+    status = result.get('status') or (result.get('result') or {}).get('status')
+    content = result.get('content') or (result.get('result') or {}).get('content') or {}
+    video_url = (content or {}).get('video_url') or result.get('video_url') or (result.get('result') or {}).get('video_url')
+    return status, video_url
+
+# 新增：跨进程文件锁（POSIX 用 fcntl，Windows 用 msvcrt，均不可用时退化为仅进程内互斥）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+LOCK_FOLDER = os.path.join(app.config['DATA_FOLDER'], 'locks')
+os.makedirs(LOCK_FOLDER, exist_ok=True)
+
+@contextmanager
+def file_lock(name):
+    """按名称加排他文件锁，阻塞直到获得；yield 锁文件路径"""
+    lock_path = os.path.join(LOCK_FOLDER, f'{secure_filename(name)}.lock')
+    with open(lock_path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield lock_path
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def output_ready(output_path):
+    return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+
+# 新增：按 task_id 单飞下载。进程内同一任务只有一个下载在跑，其余调用者等待同一结果或直接返回；
+# 进程间用文件锁串行，拿到锁后若文件已由其他进程落地则不再下载
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', '4'))
+
+class DownloadFlights:
+    def __init__(self, max_workers):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='download')
+        self._counters = {'started': 0, 'joined': 0}
+
+    def run(self, task_id, video_url, output_path, wait=True, timeout=None):
+        """确保 output_path 落地。wait=True 时返回是否成功；wait=False 时不阻塞，返回 None"""
+        with self._lock:
+            future = self._flights.get(task_id)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._flights[task_id] = future
+                self._counters['started'] += 1
+            else:
+                self._counters['joined'] += 1
+        if leader:
+            if wait:
+                self._lead(task_id, video_url, output_path, future)
+            else:
+                self._executor.submit(self._lead, task_id, video_url, output_path, future)
+        if not wait:
+            return None
+        return future.result(timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, in_flight=len(self._flights))
+
+    def _lead(self, task_id, video_url, output_path, future):
+        ok = False
+        try:
+            with file_lock(f'download_{task_id}') as lock_path:
+                ok = output_ready(output_path) or download_video(video_url, output_path)
+                if ok:
+                    # 持锁时删除锁文件：之后拿到（旧或新）锁的进程都会先看到已落地的输出，不会重复下载
+                    try:
+                        os.remove(lock_path)
+                    except OSError:
+                        pass  # Windows 下无法删除已打开的文件
+        except Exception as e:
+            print(f"Video download failed for {task_id}: {e}")
+        finally:
+            with self._lock:
+                self._flights.pop(task_id, None)
+            future.set_result(ok)
+
+download_flights = DownloadFlights(DOWNLOAD_WORKERS)
+
+# 新增：本地任务表（SQLite）。记录本服务创建/跟踪过的任务，终态任务直接由本地回答，不再请求方舟
+TASK_COLUMNS = ('task_id', 'job_id', 'model', 'params', 'image_urls', 'image_hashes', 'region', 'status',
+                'ark_status', 'error', 'remote_url', 'output_path', 'output_size', 'polls', 'render_seconds',
+                'created_at', 'updated_at', 'finished_at')
+FINAL_JOB_STATUSES = ('succeeded', 'failed')
+
+class TaskStore:
+    def __init__(self, path):
+        self._path = path
+        with db_connect(self._path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                ' task_id TEXT PRIMARY KEY, job_id TEXT, model TEXT, params TEXT, image_urls TEXT,'
+                ' image_hashes TEXT, region TEXT, status TEXT NOT NULL, ark_status TEXT, error TEXT,'
+                ' remote_url TEXT, output_path TEXT, output_size INTEGER, polls INTEGER, render_seconds REAL,'
+                ' created_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL)'
+            )
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(tasks)')}
+            if 'render_seconds' not in columns:
+                # 旧版本创建的表：补上方舟渲染耗时列
+                conn.execute('ALTER TABLE tasks ADD COLUMN render_seconds REAL')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks (status, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_job ON tasks (job_id)')
+
+    def save(self, record):
+        """写入/更新任务；record 中为 None 的字段不会覆盖已有值"""
+        row = {col: record.get(col) for col in TASK_COLUMNS}
+        for col in ('params', 'image_urls', 'image_hashes'):
+            if row[col] is not None and not isinstance(row[col], str):
+                row[col] = json.dumps(row[col], ensure_ascii=False)
+        updates = ', '.join(f'{col} = COALESCE(excluded.{col}, tasks.{col})'
+                            for col in TASK_COLUMNS if col not in ('task_id', 'created_at'))
+        with db_connect(self._path) as conn:
+            conn.execute(
+                f'INSERT INTO tasks ({", ".join(TASK_COLUMNS)}) VALUES ({", ".join("?" * len(TASK_COLUMNS))})'
+                f' ON CONFLICT(task_id) DO UPDATE SET {updates}',
+                [row[col] for col in TASK_COLUMNS],
+            )
+
+    def get(self, task_or_job_id):
+        with db_connect(self._path) as conn:
+            row = conn.execute('SELECT * FROM tasks WHERE task_id = ?', (task_or_job_id,)).fetchone()
+            if row is None:
+                row = conn.execute('SELECT * FROM tasks WHERE job_id = ?', (task_or_job_id,)).fetchone()
+        return self._decode(row) if row else None
+
+    def list(self, status=None, limit=50, before=None):
+        """按创建时间倒序分页（keyset 游标：before=(created_at, task_id)），翻页成本与总行数无关"""
+        clauses, args = [], []
+        if status:
+            clauses.append('status = ?')
+            args.append(status)
+        if before:
+            clauses.append('(created_at < ? OR (created_at = ? AND task_id < ?))')
+            args.extend([before[0], before[0], before[1]])
+        where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+        with db_connect(self._path) as conn:
+            rows = conn.execute(
+                f'SELECT * FROM tasks {where} ORDER BY created_at DESC, task_id DESC LIMIT ?', args + [limit]
+            ).fetchall()
+        return [self._decode(r) for r in rows]
+
+    def recent_durations(self, limit=500):
+        """最近成功任务的 (model, params, 方舟渲染耗时秒)，用于预热耗时模型。
+        与运行时样本同一口径；不含排队、限流等待与下载时间"""
+        with db_connect(self._path) as conn:
+            rows = conn.execute(
+                'SELECT model, params, render_seconds AS seconds FROM tasks'
+                ' WHERE status = ? AND model IS NOT NULL AND render_seconds IS NOT NULL'
+                ' ORDER BY created_at DESC LIMIT ?', ('succeeded', limit),
+            ).fetchall()
+        return [self._decode(r) for r in reversed(rows)]
+
+    @staticmethod
+    def _decode(row):
+        record = dict(row)
+        for col in ('params', 'image_urls', 'image_hashes'):
+            if record.get(col):
+                try:
+                    record[col] = json.loads(record[col])
+                except ValueError:
+                    pass
+        return record
+
+task_store = TaskStore(os.path.join(app.config['DATA_FOLDER'], 'tasks.sqlite3'))
+
+# 新增：生成结果缓存。固定 seed 时相同的 模型 + 提示词 + 参数 + 图片内容 会生成等价视频，
+# 按请求指纹复用已有任务/输出；TTL 过期或超出条目上限（按最近命中时间淘汰）后失效
+GEN_CACHE_TTL = float(os.environ.get('GEN_CACHE_TTL', str(7 * DAY)))
+GEN_CACHE_MAX_ENTRIES = int(os.environ.get('GEN_CACHE_MAX_ENTRIES', '1000'))
+
+def request_fingerprint(api_key, model_name, image_urls, video_params):
+    """规范化请求并计算指纹；seed 为 -1（随机）时结果不可复用，返回 None。
+    指纹包含 API Key 的哈希：不同账号之间不复用彼此渲染（计费）的视频"""
+    if int(video_params.get('seed', -1)) == -1:
+        return None
+    normalized = {
+        'account': hashlib.sha256(api_key.encode('utf-8')).hexdigest(),
+        'model': model_name,
+        'prompt': ' '.join(str(video_params.get('prompt', '')).split()),
+        'ratio': str(video_params.get('ratio', '')).strip().lower(),
+        'duration': int(video_params.get('duration', 5)),
+        'fps': int(video_params.get('fps', 24)),
+        'watermark': bool(video_params.get('watermark', False)),
+        'seed': int(video_params['seed']),
+        'temperature': round(float(video_params.get('temperature', 0.7)), 3),
+        # 使用图片内容哈希而非链接：同一图片换图床/重新上传仍能命中
+        'images': [rehost_cache.digest_for_url(url) or signed_url_digest(url) or f'url:{url}' for url in image_urls],
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+class GenerationCache:
+    def __init__(self, path, ttl, max_entries):
+        self._path = path
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._counters = {'hits': 0, 'misses': 0}
+        with db_connect(self._path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS generation_cache ('
+                ' fingerprint TEXT PRIMARY KEY, ref TEXT NOT NULL,'
+                ' created_at REAL NOT NULL, last_hit_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_generation_cache_hit ON generation_cache (last_hit_at)')
+
+    def lookup(self, fingerprint):
+        """返回可复用的任务（仍在进行中，或已成功且视频已落地），否则返回 None 并清理失效条目。
+        成功但本地视频缺失（下载失败或已被清理）的不算命中：方舟远端链接约 24 小时后失效"""
+        now = time.time()
+        with db_connect(self._path) as conn:
+            row = conn.execute(
+                'SELECT ref FROM generation_cache WHERE fingerprint = ? AND created_at > ?',
+                (fingerprint, now - self._ttl),
+            ).fetchone()
+        job = job_manager.get(row['ref']) if row else None
+        if job is not None and job['status'] == 'succeeded':
+            output_path = job.get('output_path') or os.path.join(app.config['OUTPUT_FOLDER'], f"{job['task_id']}.mp4")
+            if not output_ready(output_path):
+                job = None
+        if job is None or job['status'] == 'failed':
+            if row:
+                self.forget(fingerprint)
+            self._counters['misses'] += 1
+            return None
+        with db_connect(self._path) as conn:
+            conn.execute('UPDATE generation_cache SET last_hit_at = ?, hits = hits + 1 WHERE fingerprint = ?',
+                         (now, fingerprint))
+        self._counters['hits'] += 1
+        return job
+
+    def remember(self, fingerprint, ref):
+        now = time.time()
+        with db_connect(self._path) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO generation_cache (fingerprint, ref, created_at, last_hit_at, hits)'
+                ' VALUES (?, ?, ?, ?, 0)', (fingerprint, ref, now, now),
+            )
+            conn.execute('DELETE FROM generation_cache WHERE created_at <= ?', (now - self._ttl,))
+            conn.execute(
+                'DELETE FROM generation_cache WHERE fingerprint IN ('
+                ' SELECT fingerprint FROM generation_cache ORDER BY last_hit_at DESC LIMIT -1 OFFSET ?)',
+                (self._max_entries,),
+            )
+
+    def forget(self, fingerprint):
+        with db_connect(self._path) as conn:
+            conn.execute('DELETE FROM generation_cache WHERE fingerprint = ?', (fingerprint,))
+
+    def stats(self):
+        return dict(self._counters)
+
+generation_cache = GenerationCache(os.path.join(app.config['DATA_FOLDER'], 'tasks.sqlite3'),
+                                   GEN_CACHE_TTL, GEN_CACHE_MAX_ENTRIES)
+
+def _cache_bypassed(data):
+    return str(data.get('no_cache', data.get('bypass_cache', ''))).lower() in ('1', 'true', 'yes')
+
+def _cached_generation_response(job, message):
+    """命中生成缓存时的响应：已完成直接返回视频地址，进行中返回同一任务供前端继续监听"""
+    payload = {
+        'success': True,
+        'cached': True,
+        'job_id': job['job_id'],
+        'task_id': job['task_id'] or job['job_id'],
+        'status': job['status'],
+        'message': message,
+    }
+    if job['status'] == 'succeeded':
+        payload['video_url'] = _job_local_url(job) or job['remote_url']
+        return jsonify(payload)
+    return jsonify(payload), 202
+
+# 新增：任务状态变更通知。SSE 连接按 job_id / task_id 订阅，只被自己关心的任务唤醒；
+# 全局版本号供批次调度线程等待任意任务变化
+class TaskEventBus:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._version = 0
+        self._subscribers = {}
+
+    def publish(self, *keys):
+        """通知任务变化；keys 为该任务的 job_id / task_id"""
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+            events = [event for key in keys if key for event in self._subscribers.get(key, ())]
+        for event in events:
+            event.set()
+
+    def subscribe(self, keys):
+        """订阅一组任务，返回在其中任一任务变化时被 set 的 Event"""
+        event = threading.Event()
+        with self._cond:
+            for key in keys:
+                self._subscribers.setdefault(key, set()).add(event)
+        return event
+
+    def unsubscribe(self, keys, event):
+        with self._cond:
+            for key in keys:
+                subscribers = self._subscribers.get(key)
+                if subscribers is not None:
+                    subscribers.discard(event)
+                    if not subscribers:
+                        del self._subscribers[key]
+
+    def version(self):
+        return self._version
+
+    def wait(self, since, timeout):
+        """等待版本号变化或超时，返回最新版本号"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != since, timeout)
+            return self._version
+
+    def stats(self):
+        with self._cond:
+            return {'subscribed_tasks': len(self._subscribers)}
+
+task_events_bus = TaskEventBus()
+
+# 新增：后台任务参数（线程池大小、排队上限、单任务最长等待秒数）
+JOB_WORKERS = int(os.environ.get('ARK_JOB_WORKERS', '4'))
+JOB_QUEUE_LIMIT = int(os.environ.get('ARK_JOB_QUEUE_LIMIT', '100'))
+JOB_MAX_WAIT = int(os.environ.get('ARK_JOB_MAX_WAIT', '600'))
+JOB_RETENTION = float(os.environ.get('ARK_JOB_RETENTION', '600'))  # 已终结任务在内存中保留的秒数，之后由本地任务表回答
+
+# 新增：共享状态轮询器（单线程调度所有在途任务，结果写入内存状态表供路由 O(1) 读取）
+POLL_MIN_INTERVAL = float(os.environ.get('ARK_POLL_MIN_INTERVAL', '2'))
+POLL_MAX_INTERVAL = float(os.environ.get('ARK_POLL_MAX_INTERVAL', '15'))
+POLL_CONCURRENCY = int(os.environ.get('ARK_POLL_CONCURRENCY', '8'))
+POLL_ERROR_BUDGET = int(os.environ.get('ARK_POLL_ERROR_BUDGET', '10'))  # 可重试错误连续出现的上限
+TERMINAL_STATUSES = {'succeeded', 'failed', 'expired', 'cancelled'}
+
+# 新增：渲染耗时模型。按 (model, duration, fps, ratio) 学习最近成功任务的耗时分布，轮询器据此安排查询：
+# 远早于预计完成时稀疏轮询，处于 p10~p90 区间时密集轮询，超出后逐步放缓；所有间隔加随机抖动避免同步
+DURATION_SAMPLES = int(os.environ.get('ARK_DURATION_SAMPLES', '50'))  # 每个画像保留的最近样本数
+DURATION_MIN_SAMPLES = 3
+POLL_EARLY_MAX_INTERVAL = float(os.environ.get('ARK_POLL_EARLY_MAX_INTERVAL', '30'))
+POLL_JITTER = 0.2
+
+def render_profile(model, params):
+    """任务画像：(model, duration, fps, ratio)"""
+    params = params or {}
+    try:
+        duration, fps = int(params.get('duration', 5)), int(params.get('fps', 24))
+    except (TypeError, ValueError):
+        duration, fps = 5, 24
+    return model or '', duration, fps, str(params.get('ratio', '')).strip().lower()
+
+class DurationModel:
+    """画像 → 最近成功任务的渲染耗时（秒）。同画像样本不足时退回同模型的全部样本。
+    分位数按画像缓存，有新样本时整体失效（轮询调度与进度估算频繁读取，样本很少更新）"""
+
+    def __init__(self, max_samples):
+        self._lock = threading.Lock()
+        self._max_samples = max_samples
+        self._samples = {}
+        self._by_model = {}
+        self._quantiles = {}
+
+    def observe(self, profile, seconds):
+        if seconds is None or seconds <= 0:
+            return
+        with self._lock:
+            self._samples.setdefault(profile, deque(maxlen=self._max_samples)).append(seconds)
+            self._by_model.setdefault(profile[0], deque(maxlen=self._max_samples * 4)).append(seconds)
+            self._quantiles.clear()
+
+    def quantiles(self, profile):
+        """返回 (p10, p50, p90)，样本不足返回 None"""
+        with self._lock:
+            if profile in self._quantiles:
+                return self._quantiles[profile]
+            samples = self._samples.get(profile)
+            if not samples or len(samples) < DURATION_MIN_SAMPLES:
+                samples = self._by_model.get(profile[0])
+            if not samples or len(samples) < DURATION_MIN_SAMPLES:
+                result = None
+            else:
+                ordered = sorted(samples)
+                pick = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+                result = pick(0.1), pick(0.5), pick(0.9)
+            self._quantiles[profile] = result
+            return result
+
+    def stats(self):
+        with self._lock:
+            profiles = {profile: sorted(s) for profile, s in self._samples.items()}
+        return {'/'.join(str(p) for p in profile): {
+            'samples': len(s),
+            'p50': round(s[len(s) // 2], 1),
+            'p90': round(s[min(len(s) - 1, int(len(s) * 0.9))], 1),
+        } for profile, s in profiles.items()}
+
+duration_model = DurationModel(DURATION_SAMPLES)
+try:
+    # 启动时用本地任务表中最近的成功任务预热
+    for _row in task_store.recent_durations():
+        duration_model.observe(render_profile(_row['model'], _row['params']), _row['seconds'])
+except sqlite3.Error as e:
+    print(f"Duration model warm-up failed: {e}")
+
+def task_render_seconds(data):
+    """从方舟任务响应的 created_at / updated_at 计算渲染耗时，缺失时返回 None"""
+    try:
+        created, updated = float(data.get('created_at')), float(data.get('updated_at'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return updated - created if updated > created else None
+
+class TaskPoller:
+    """所有在途方舟任务共用一个轮询调度线程。
+
+    - 同一 task_id 只会被登记一次，重复 watch 仅追加监听器（请求合并）；
+    - 有耗时模型（duration_model）时按预计完成时间安排轮询：早期稀疏、p10~p90 密集、之后放缓；
+      无样本时状态未变化则间隔按 1.5 倍递增至 POLL_MAX_INTERVAL，状态变化后重置；间隔均加抖动；
+    - 每次状态变化都会写入内部状态表并通知监听器 listener(task_id, state)（路由读取的是 job_manager）；
+      state['done'] 为 True 时表示已终结（成功/失败/超时），任务随即移出调度并丢弃其状态；
+    - 查询错误按 classify_error 分类：不可重试（任务不存在、鉴权、请求错误）立即终结，
+      可重试错误连续超过 POLL_ERROR_BUDGET 次后终结，state['error_kind'] 记录类别。
+    """
+
+    def __init__(self, min_interval, max_interval, concurrency):
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='ark-poll')
+        self._cond = threading.Condition()
+        self._heap = []
+        self._watched = {}
+        self._states = {}
+        self._thread = None
+        self._counters = {'completed': 0, 'completed_polls': 0, 'pushes': 0}
+
+    def watch(self, task_id, api_key, listener=None, max_wait=JOB_MAX_WAIT, profile=None, callback=False):
+        """登记任务；已登记时只追加监听器。任务终结后状态即被丢弃，再次登记会重新查询
+        （job_manager 对已终结任务由 task_store 回答，不会再登记）。profile 为 render_profile() 画像，用于按耗时模型安排轮询；callback 为 True 表示该任务
+        创建时带了回调地址，轮询仅作兜底，间隔不低于 CALLBACK_POLL_INTERVAL"""
+        with self._cond:
+            entry = self._watched.get(task_id)
+            if entry is None:
+                now = time.time()
+                entry = {
+                    'api_key': api_key,
+                    'interval': self._min_interval,
+                    'next_at': now,
+                    'deadline': now + max_wait,
+                    'inflight': False,
+                    'errors': 0,
+                    'profile': profile,
+                    'callback': callback,
+                    'started_at': now,
+                    'listeners': [],
+                }
+                self._watched[task_id] = entry
+                self._states[task_id] = {
+                    'status': None, 'data': None, 'error': None, 'error_kind': None,
+                    'done': False, 'polls': 0, 'updated_at': now,
+                }
+                heapq.heappush(self._heap, (entry['next_at'], task_id))
+                self._ensure_thread()
+                self._cond.notify()
+            if listener is not None:
+                entry['listeners'].append(listener)
+
+    def active_count(self):
+        return len(self._watched)
+
+    def stats(self):
+        with self._cond:
+            completed = self._counters['completed']
+            return {
+                'active_tasks': len(self._watched),
+                'completed_tasks': completed,
+                'avg_polls_per_task': round(self._counters['completed_polls'] / completed, 2) if completed else None,
+                'callback_pushes': self._counters['pushes'],
+            }
+
+    def _next_interval(self, entry, changed, now):
+        """下一次轮询的间隔（已加抖动）"""
+        q = duration_model.quantiles(entry['profile']) if entry['profile'] else None
+        if q is None:
+            interval = self._min_interval if changed else min(entry['interval'] * 1.5, self._max_interval)
+        else:
+            p10, _, p90 = q
+            elapsed = now - entry['started_at']
+            if elapsed < p10:
+                # 远早于预计完成：每次等待剩余时间的一半，逐步逼近 p10
+                interval = min(POLL_EARLY_MAX_INTERVAL, max(self._min_interval, (p10 - elapsed) / 2))
+            elif elapsed <= p90:
+                interval = self._min_interval
+            else:
+                interval = min(max(entry['interval'], self._min_interval) * 1.5, self._max_interval)
+        entry['interval'] = interval
+        if entry['callback']:
+            interval = max(interval, CALLBACK_POLL_INTERVAL)
+        return interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name='ark-poller', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        _, task_id = heapq.heappop(self._heap)
+                        entry = self._watched.get(task_id)
+                        if entry is None or entry['inflight']:
+                            continue
+                        entry['inflight'] = True
+                        break
+                    timeout = (self._heap[0][0] - now) if self._heap else None
+                    self._cond.wait(timeout)
+            self._executor.submit(self._poll_one, task_id, entry)
+
+    def push(self, task_id, data):
+        """外部推送（方舟回调）的任务状态，按一次轮询结果处理；任务未在调度中时返回 False"""
+        with self._cond:
+            entry = self._watched.get(task_id)
+            if entry is None:
+                return False
+            self._counters['pushes'] += 1
+            status, video_url = _extract_result(data)
+            if status == 'succeeded' and not video_url:
+                # 成功回调未携带视频链接：不据此终结任务，立即查询一次取完整结果
+                if not entry['inflight']:
+                    heapq.heappush(self._heap, (time.time(), task_id))
+                    self._cond.notify()
+                return True
+        metric_task_updates.inc('callback')
+        self._apply(task_id, entry, data, None, polled=False)
+        return True
+
+    def _poll_one(self, task_id, entry):
+        data, err = None, None
+        try:
+            data = fetch_task(entry['api_key'], task_id)
+        except Exception as e:
+            err = classify_error(e, op='get')
+        metric_task_updates.inc('poll')
+        self._apply(task_id, entry, data, err, polled=True)
+
+    def _apply(self, task_id, entry, data, err, polled):
+        error = str(err) if err is not None else None
+        status, _ = _extract_result(data) if data else (None, None)
+        now = time.time()
+        with self._cond:
+            if self._watched.get(task_id) is not entry:
+                return  # 回调与轮询结果先后到达，已终结的任务不再处理
+            state = self._states[task_id]
+            changed = data is not None and status != state['status']
+            if polled:
+                state['polls'] += 1
+            state['updated_at'] = now
+            if data is not None:
+                entry['errors'] = 0
+                state.update(status=status, data=data, error=None, error_kind=None)
+                try:
+                    # 以方舟记录的创建时间为起点（跟踪外部创建的任务时比登记时间更准确）
+                    entry['started_at'] = min(entry['started_at'], float(data.get('created_at')))
+                except (TypeError, ValueError):
+                    pass
+            else:
+                entry['errors'] += 1
+                state.update(error=error, error_kind=err.kind)
+            if status in TERMINAL_STATUSES:
+                state['done'] = True
+            elif err is not None and (not err.retryable or entry['errors'] > POLL_ERROR_BUDGET):
+                state['done'] = True
+            elif now >= entry['deadline']:
+                state.update(done=True, error=f'Task timeout. last_error={error}' if error else 'Task timeout')
+            notify = changed or state['done']
+            snapshot = dict(state)
+            if state['done']:
+                self._watched.pop(task_id, None)
+                self._states.pop(task_id, None)
+                self._counters['completed'] += 1
+                self._counters['completed_polls'] += state['polls']
+            elif polled:
+                entry['next_at'] = now + self._next_interval(entry, changed, now)
+                entry['inflight'] = False
+                heapq.heappush(self._heap, (entry['next_at'], task_id))
+                self._cond.notify()
+            listeners = list(entry['listeners'])
+        if snapshot['done']:
+            metric_task_polls.observe(snapshot['polls'], status if status in TERMINAL_STATUSES else 'error')
+        if notify:
+            for listener in listeners:
+                try:
+                    listener(task_id, snapshot)
+                except Exception as e:
+                    print(f"Poll listener failed for {task_id}: {e}")
+
+# 新增：后台任务管理器（有界线程池驱动 create → poll → download，路由只读取任务状态）
+
+class JobQueueFull(Exception):
+    pass
+
+class JobManager:
+    """进程内任务管理：请求线程只负责入队，耗时的创建/轮询/下载在后台线程池中完成。
+
+    任务可通过 job_id 或方舟 task_id 查询；状态依次为
+    queued → creating → running → downloading → succeeded / failed。
+    已终结的任务在内存中保留 retention 秒后移除，之后的查询由 task_store 回答。
+    """
+
+    def __init__(self, max_workers, queue_limit, retention):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ark-job')
+        self._queue_limit = queue_limit
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._by_task = {}
+        self._finished = deque()  # (终结时间, job_id)，按时间先后
+        self._pending = 0
+
+    def submit(self, api_key, model_name, image_urls, video_params):
+        """创建新任务并立即返回任务快照（不等待方舟创建完成）"""
+        job = self._new_job(task_id=None, status='queued')
+        job.update(model=model_name, params=video_params, image_urls=list(image_urls))
+        job_id = self._enqueue(job, self._run, job, api_key, model_name, image_urls, video_params)
+        return self.get(job_id)
+
+    def track(self, api_key, task_id):
+        """跟踪一个已在方舟创建的任务（后台轮询 + 下载）；重复跟踪同一 task_id 直接返回已有任务"""
+        job = self._new_job(task_id=task_id, status='running')
+        job['tracked'] = True
+        job_id = self._enqueue(job, self._follow, job, api_key)
+        return self.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {'total': len(self._jobs), 'pending': self._pending, 'finished_retained': len(self._finished)}
+
+    def in_flight_paths(self):
+        """未终结任务引用的本地文件：输出视频及由本服务提供的输入图片"""
+        with self._lock:
+            jobs = [dict(job) for job in self._jobs.values() if job['status'] not in FINAL_JOB_STATUSES]
+        paths = []
+        for job in jobs:
+            if job['task_id']:
+                paths.append(os.path.join(app.config['OUTPUT_FOLDER'], f"{job['task_id']}.mp4"))
+            for url in job.get('image_urls') or []:
+                path = served_image_path(url)
+                if path:
+                    paths.append(path)
+        return paths
+
+    def get(self, job_or_task_id):
+        """先查内存中的在途任务，再查本地任务表中已终结的任务（均不请求方舟）"""
+        with self._lock:
+            job = self._jobs.get(job_or_task_id)
+            if job is None:
+                job_id = self._by_task.get(job_or_task_id)
+                job = self._jobs.get(job_id) if job_id else None
+            if job:
+                return dict(job)
+        record = task_store.get(job_or_task_id)
+        if record and record['status'] in FINAL_JOB_STATUSES:
+            return record
+        return None
+
+    def _new_job(self, task_id, status):
+        now = time.time()
+        return {
+            'job_id': uuid.uuid4().hex,
+            'task_id': task_id,
+            'status': status,
+            'ark_status': None,
+            'error': None,
+            'error_kind': None,
+            'polls': 0,
+            'render_seconds': None,
+            'callback': False,
+            'tracked': False,
+            'video_url': None,
+            'remote_url': None,
+            'output_path': None,
+            'model': None,
+            'params': None,
+            'image_urls': None,
+            'created_at': now,
+            'updated_at': now,
+        }
+
+    def _enqueue(self, job, fn, *args):
+        """登记并提交任务，返回实际生效的 job_id（同一 task_id 已在跟踪时复用已有任务）"""
+        with self._lock:
+            self._prune(time.time())
+            existing = self._by_task.get(job['task_id']) if job['task_id'] else None
+            if existing:
+                return existing
+            if self._pending >= self._queue_limit:
+                raise JobQueueFull(f'Too many pending jobs ({self._pending})')
+            self._pending += 1
+            self._jobs[job['job_id']] = job
+            if job['task_id']:
+                self._by_task[job['task_id']] = job['job_id']
+        try:
+            self._executor.submit(self._guarded, job, fn, *args)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                self._jobs.pop(job['job_id'], None)
+                if job['task_id']:
+                    self._by_task.pop(job['task_id'], None)
+            raise
+        return job['job_id']
+
+    def _update(self, job, **fields):
+        now = time.time()
+        with self._lock:
+            was_final = job['status'] in FINAL_JOB_STATUSES
+            job.update(fields)
+            job['updated_at'] = now
+            if job['job_id'] in self._jobs:
+                if job.get('task_id'):
+                    self._by_task[job['task_id']] = job['job_id']
+                if not was_final and job['status'] in FINAL_JOB_STATUSES:
+                    self._finished.append((now, job['job_id']))
+            self._prune(now)
+            snapshot = dict(job)
+        if snapshot['task_id'] and (snapshot['status'] in FINAL_JOB_STATUSES or snapshot['status'] == 'downloading'):
+            # 方舟侧已终结，释放在途任务名额
+            ark_limiter.release(snapshot['task_id'])
+        if snapshot['task_id']:
+            self._persist(snapshot)
+        task_events_bus.publish(snapshot['job_id'], snapshot['task_id'])
+
+    def _persist(self, job):
+        if job['tracked'] and job['ark_status'] is None and job['error_kind'] == 'not_found':
+            # 按任意 id 查询状态时登记的跟踪任务：方舟从未确认存在，不写入任务表
+            return
+        record = dict(job, region=region_router.region_of(job['task_id']))
+        if job['status'] in FINAL_JOB_STATUSES:
+            record['finished_at'] = job['updated_at']
+        if job.get('output_path') and output_ready(job['output_path']):
+            record['output_size'] = os.path.getsize(job['output_path'])
+        if job.get('image_urls'):
+            record['image_hashes'] = [rehost_cache.digest_for_url(url) for url in job['image_urls']]
+        try:
+            task_store.save(record)
+        except sqlite3.Error as e:
+            print(f"Task store write failed for {job['task_id']}: {e}")
+
+    def _prune(self, now):
+        """移除超过保留期的已终结任务（调用方持有 _lock）；终态已写入 task_store"""
+        while self._finished and self._finished[0][0] <= now - self._retention:
+            _, job_id = self._finished.popleft()
+            job = self._jobs.pop(job_id, None)
+            if job and job['task_id'] and self._by_task.get(job['task_id']) == job_id:
+                del self._by_task[job['task_id']]
+
+    def _guarded(self, job, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print(f"Job {job['job_id']} crashed: {e}")
+            self._update(job, status='failed', error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _continue(self, job, fn, *args):
+        """提交后续阶段（不受排队上限限制，避免已在途任务被拒绝）"""
+        with self._lock:
+            self._pending += 1
+        self._executor.submit(self._guarded, job, fn, *args)
+
+    def _run(self, job, api_key, model_name, image_urls, video_params):
+        self._update(job, status='creating')
+        task_result = create_video_task(api_key, model_name, image_urls, **video_params)
+        if 'error' in task_result:
+            self._update(job, status='failed', error=f'Task creation failed: {task_result["error"]}',
+                         error_kind=task_result.get('error_kind'))
+            return
+        task_id = task_result.get('id')
+        if not task_id:
+            self._update(job, status='failed', error='No task ID returned')
+            return
+        self._update(job, task_id=task_id, status='running', callback=bool(task_result.get('callback')))
+        self._follow(job, api_key)
+
+    def _follow(self, job, api_key):
+        """交给共享轮询器，不占用工作线程等待渲染"""
+        profile = render_profile(job['model'], job['params']) if job.get('model') else None
+        task_poller.watch(job['task_id'], api_key, listener=lambda task_id, state: self._on_poll(job, state),
+                          profile=profile, callback=job.get('callback', False))
+
+    def _on_poll(self, job, state):
+        status, video_url = _extract_result(state['data'])
+        if not state['done']:
+            self._update(job, ark_status=status, polls=state['polls'])
+            return
+        render_seconds = None
+        if status == 'succeeded':
+            render_seconds = task_render_seconds(state['data']) or (time.time() - job['created_at'])
+            metric_render_seconds.observe(render_seconds, job.get('model') or state['data'].get('model') or 'unknown')
+            if job.get('model'):
+                duration_model.observe(render_profile(job['model'], job['params']), render_seconds)
+        if status == 'succeeded' and video_url:
+            # 渲染耗时写入任务表，重启后按同一口径预热耗时模型
+            self._update(job, ark_status=status, status='downloading', remote_url=video_url, polls=state['polls'],
+                         render_seconds=render_seconds)
+            self._continue(job, self._download, job, video_url)
+        elif state['error'] and status not in TERMINAL_STATUSES:
+            self._update(job, status='failed', error=f'Task polling failed: {state["error"]}',
+                         error_kind=state.get('error_kind'), polls=state['polls'])
+        else:
+            self._update(job, ark_status=status, status='failed', error=f'Task failed with status: {status or "unknown"}',
+                         polls=state['polls'])
+
+    def _download(self, job, video_url):
+        output_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{job['task_id']}.mp4")
+        if download_flights.run(job['task_id'], video_url, output_path):
+            self._update(job, status='succeeded', output_path=output_path)
+            if job.get('model'):
+                # 只统计经 submit 提交的任务；track 登记的外部任务没有提交时间
+                metric_generation_seconds.observe(time.time() - job['created_at'], job['model'])
+        else:
+            # 下载失败时仍视为成功，前端回退使用远端地址
+            self._update(job, status='succeeded')
+
+task_poller = TaskPoller(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_CONCURRENCY)
+job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_LIMIT, JOB_RETENTION)
+
+# 新增：后台清理（janitor）。按目录的字节/文件数/最长保留时间预算淘汰文件，最近最少被访问的先删；
+# 在途任务引用的文件（输出视频、签名直链/本地替身图床上的输入图片）与宽限期内的新文件不会被删除
+JANITOR_INTERVAL = float(os.environ.get('JANITOR_INTERVAL', '600'))  # 0 关闭
+JANITOR_GRACE = float(os.environ.get('JANITOR_GRACE', '3600'))  # 新文件至少保留的秒数（上传后尚未生成）
+OUTPUT_MAX_BYTES = int(os.environ.get('OUTPUT_MAX_BYTES', str(20 * 1024 ** 3)))  # 0 表示不限
+OUTPUT_MAX_FILES = int(os.environ.get('OUTPUT_MAX_FILES', '0'))
+OUTPUT_MAX_AGE = float(os.environ.get('OUTPUT_MAX_AGE', str(30 * DAY)))
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', str(5 * 1024 ** 3)))
+UPLOAD_MAX_FILES = int(os.environ.get('UPLOAD_MAX_FILES', '0'))
+UPLOAD_MAX_AGE = float(os.environ.get('UPLOAD_MAX_AGE', str(7 * DAY)))
+SERVED_TOUCH_INTERVAL = 60
+
+def mark_served(file_path, st=None):
+    """记录文件最近一次被访问的时间（写入 atime，保留 mtime 以免 ETag 变化），供清理按 LRU 淘汰"""
+    try:
+        st = st or os.stat(file_path)
+        now = time.time()
+        if now - st.st_atime > SERVED_TOUCH_INTERVAL:
+            os.utime(file_path, (now, st.st_mtime))
+    except OSError:
+        pass
+
+def served_image_path(url):
+    """本服务提供的图片链接（签名有效的直链 / 本地替身图床）→ 本地文件路径，其他链接返回 None"""
+    file_path = signed_upload_file_path(url)
+    if file_path:
+        return file_path
+    if url.startswith(LOCAL_REHOST_BASE_URL.rstrip('/') + '/local_rehost/'):
+        file_path = os.path.join(LOCAL_REHOST_FOLDER, secure_filename(url.rsplit('/', 1)[-1]))
+        return file_path if os.path.isfile(file_path) else None
+    return None
+
+class Janitor:
+    """周期性清理线程。budgets: [{'name', 'folder', 'max_bytes', 'max_files', 'max_age'}, ...]，
+    上限为 0 表示不限制该项"""
+
+    def __init__(self, budgets, interval, grace):
+        self._budgets = budgets
+        self._interval = interval
+        self._grace = grace
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counters = {b['name']: {'runs': 0, 'files_evicted': 0, 'bytes_reclaimed': 0, 'skipped_in_use': 0,
+                                      'files': 0, 'bytes': 0, 'last_run_at': None, 'measured_at': None}
+                          for b in budgets}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and self._interval > 0:
+                self._thread = threading.Thread(target=self._loop, name='janitor', daemon=True)
+                self._thread.start()
+
+    def run_once(self):
+        protected = {os.path.abspath(p) for p in job_manager.in_flight_paths()}
+        for budget in self._budgets:
+            try:
+                self._sweep(budget, protected)
+            except Exception as e:
+                print(f"Janitor sweep of {budget['folder']} failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(c) for name, c in self._counters.items()}
+
+    def usage(self, max_age):
+        """各目录当前占用 {name: (files, bytes)}；距上次清理/统计超过 max_age 秒时只扫描不删除"""
+        now = time.time()
+        result = {}
+        for budget in self._budgets:
+            with self._lock:
+                c = self._counters[budget['name']]
+                fresh = c['measured_at'] is not None and now - c['measured_at'] <= max_age
+                result[budget['name']] = (c['files'], c['bytes'])
+            if not fresh:
+                entries = self._scan(budget['folder'])
+                files, total = len(entries), sum(e[2] for e in entries)
+                with self._lock:
+                    c.update(files=files, bytes=total, measured_at=now)
+                result[budget['name']] = (files, total)
+        return result
+
+    def _loop(self):
+        while not self._stop.wait(self._interval):
+            self.run_once()
+
+    @staticmethod
+    def _scan(folder):
+        """[(最近使用时间, mtime, size, path), ...]，跳过正在写入的 .part 文件"""
+        entries = []
+        for root, _, filenames in os.walk(folder):
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue  # 正在写入
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((max(st.st_atime, st.st_mtime), st.st_mtime, st.st_size, path))
+        return entries
+
+    def _sweep(self, budget, protected):
+        now = time.time()
+        entries = self._scan(budget['folder'])
+        entries.sort()
+        total_bytes = sum(e[2] for e in entries)
+        total_files = len(entries)
+        evicted = reclaimed = skipped = 0
+        for last_used, mtime, size, path in entries:
+            over = ((budget['max_age'] and now - last_used > budget['max_age'])
+                    or (budget['max_bytes'] and total_bytes > budget['max_bytes'])
+                    or (budget['max_files'] and total_files > budget['max_files']))
+            if not over:
+                break  # 按最近使用时间升序，之后的文件更新，不再超出任何预算
+            if now - mtime < self._grace or os.path.abspath(path) in protected:
+                skipped += 1
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            total_files -= 1
+            evicted += 1
+            reclaimed += size
+        with self._lock:
+            c = self._counters[budget['name']]
+            c['runs'] += 1
+            c['files_evicted'] += evicted
+            c['bytes_reclaimed'] += reclaimed
+            c['skipped_in_use'] += skipped
+            c['files'] = total_files
+            c['bytes'] = total_bytes
+            c['last_run_at'] = now
+            c['measured_at'] = now
+
+janitor = Janitor([
+    {'name': 'outputs', 'folder': app.config['OUTPUT_FOLDER'],
+     'max_bytes': OUTPUT_MAX_BYTES, 'max_files': OUTPUT_MAX_FILES, 'max_age': OUTPUT_MAX_AGE},
+    {'name': 'uploads', 'folder': app.config['UPLOAD_FOLDER'],
+     'max_bytes': UPLOAD_MAX_BYTES, 'max_files': UPLOAD_MAX_FILES, 'max_age': UPLOAD_MAX_AGE},
+], JANITOR_INTERVAL, JANITOR_GRACE)
+if multiprocessing.parent_process() is None:
+    janitor.start()  # spawn 出的预处理子进程会重新导入本模块，不在其中启动清理线程
+
+def _job_local_url(job):
+    """视频已落地时返回本地代理下载地址；未落地则在后台单飞补拉一次并返回 None（调用方回退远端地址）"""
+    output_path = job.get('output_path') or os.path.join(app.config['OUTPUT_FOLDER'], f"{job['task_id']}.mp4")
+    if output_ready(output_path):
+        return url_for('download_video_file', filename=os.path.basename(output_path), _external=True)
+    if job.get('remote_url') and job['status'] == 'succeeded':
+        download_flights.run(job['task_id'], job['remote_url'], output_path, wait=False)
     return None
 
-def create_video_task(api_key, model_name, image_urls, **kwargs):
-    """使用方舟SDK创建参考图生视频任务，返回 {"id": task_id} 或 {"error": ...} """
+# 新增：批量生成。一个批次包含 N 个条目（图片链接 + 条目参数），同时在途的条目数不超过并发上限，
+# 有条目终结即补交下一个；条目经 job_manager 提交（创建 → 共享轮询 → 下载），与 /generate 走同一条路径
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '200'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+BATCH_HISTORY = int(os.environ.get('BATCH_HISTORY', '1000'))
+BATCH_PUMP_INTERVAL = 5
+
+def build_video_params(data, default_prompt):
+    """从请求字段构建视频参数（seed -1 表示随机，temperature 限制在 [0, 1]）"""
     try:
-        # 构建包含视频参数的prompt
-        base_prompt = kwargs.get('prompt', 'Generate a video based on the provided images')
-        ratio = kwargs.get('ratio', '1092x1080')
-        duration = int(kwargs.get('duration', 5))
-        fps = int(kwargs.get('fps', 24))
-        watermark = 'false' if not kwargs.get('watermark', False) else 'true'
-        seed = int(kwargs.get('seed', -1))
-        temperature = float(kwargs.get('temperature', 0.7))
-        
-        # 按照方舟API格式添加参数到prompt
-        full_prompt = f"{base_prompt} --ratio {ratio} --dur {duration} --fps {fps} --wm {watermark}"
-        if seed != -1:
-            full_prompt += f" --seed {seed}"
-        if temperature != 0.7:
-            full_prompt += f" --temperature {temperature}"
-        
-        content = [
-            {
-                "type": "text",
-                "text": full_prompt
+        seed_val = max(-1, int(data.get('seed', -1)))
+    except Exception:
+        seed_val = -1
+    try:
+        temperature_val = min(1.0, max(0.0, float(data.get('temperature', 0.7))))
+    except Exception:
+        temperature_val = 0.7
+    return {
+        'prompt': data.get('prompt', default_prompt),
+        'ratio': data.get('ratio', '1092x1080'),
+        'duration': int(data.get('duration', 5)),
+        'fps': int(data.get('fps', 24)),
+        'watermark': data.get('watermark', False),
+        'seed': seed_val,
+        'temperature': temperature_val,
+    }
+
+class BatchManager:
+    """批次调度：submit() 登记批次并立即派发首批条目，后台调度线程在任务状态变化时补交后续条目"""
+
+    def __init__(self, history):
+        self._lock = threading.Lock()
+        self._batches = OrderedDict()
+        self._active = set()
+        self._history = history
+        self._thread = None
+
+    def submit(self, api_key, items, concurrency):
+        """items: [{'model', 'image_urls', 'params', 'fingerprint'}, ...]，返回批次 id"""
+        batch = {
+            'batch_id': uuid.uuid4().hex,
+            'api_key': api_key,
+            'concurrency': concurrency,
+            'created_at': time.time(),
+            'finished_at': None,
+            'lock': threading.Lock(),  # 请求线程与调度线程互斥派发，避免同一条目重复提交
+            'items': [dict(item, index=i, job_id=None, error=None) for i, item in enumerate(items)],
+        }
+        with self._lock:
+            self._batches[batch['batch_id']] = batch
+            self._active.add(batch['batch_id'])
+            while len(self._batches) > self._history:
+                old_id, _ = self._batches.popitem(last=False)
+                self._active.discard(old_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='batch-dispatch', daemon=True)
+                self._thread.start()
+        self._pump(batch)
+        return batch['batch_id']
+
+    def get(self, batch_id):
+        """批次汇总状态与各条目结果（不请求方舟）"""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None
+            items = [dict(item) for item in batch['items']]
+        counts = {}
+        results = []
+        for item in items:
+            job = job_manager.get(item['job_id']) if item['job_id'] else None
+            status = job['status'] if job else ('failed' if item['error'] else 'pending')
+            counts[status] = counts.get(status, 0) + 1
+            result = {
+                'index': item['index'],
+                'job_id': item['job_id'],
+                'task_id': job['task_id'] if job else None,
+                'status': status,
+                'cached': item.get('cached', False),
             }
-        ]
-        for url in image_urls:
-            content.append({
-                "type": "image_url",
-                "image_url": {"url": url},
-                "role": "reference_image",
-            })
-        model_id = model_name or "seedance-1-0-lite-i2v-250428"
+            if status == 'succeeded':
+                result['video_url'] = _job_local_url(job) or job['remote_url']
+            elif status == 'failed':
+                result['error'] = (job['error'] if job else None) or item['error']
+            results.append(result)
+        done = counts.get('succeeded', 0) + counts.get('failed', 0)
+        return {
+            'batch_id': batch_id,
+            'status': 'completed' if done == len(items) else 'running',
+            'total': len(items),
+            'done': done,
+            'progress': int(100 * done / len(items)) if items else 100,
+            'concurrency': batch['concurrency'],
+            'counts': counts,
+            'created_at': batch['created_at'],
+            'finished_at': batch['finished_at'],
+            'items': results,
+        }
 
-        last_err = None
-        for client in get_ark_clients(api_key):
-            try:
-                create_result = client.content_generation.tasks.create(
-                    model=model_id,
-                    content=content,
-                )
-                task_id = None
-                if isinstance(create_result, dict):
-                    task_id = create_result.get('id') or create_result.get('task_id') or create_result.get('result', {}).get('id')
-                else:
-                    try:
-                        data = json.loads(create_result.model_dump_json())
-                        task_id = data.get('id') or data.get('task_id') or data.get('result', {}).get('id')
-                    except Exception:
-                        task_id = getattr(create_result, 'id', None)
-                if task_id:
-                    return {"id": task_id}
-            except Exception as e:
-                last_err = e
-                continue
-        return {"error": f"Create task failed on all base_urls: {last_err}"}
-    except Exception as e:
-        return {"error": str(e)}
+    def stats(self):
+        with self._lock:
+            return {'batches': len(self._batches), 'active': len(self._active)}
 
-def poll_task_status(api_key, task_id, max_wait_time=300):
-    """使用方舟SDK轮询任务状态，返回最终结果。成功时 status == 'succeeded' 且 content.video_url 可用。"""
-    try:
-        start_time = time.time()
-        last_err = None
-        clients = get_ark_clients(api_key)
-        while time.time() - start_time < max_wait_time:
-            for client in clients:
+    def _loop(self):
+        version = task_events_bus.version()
+        while True:
+            version = task_events_bus.wait(version, BATCH_PUMP_INTERVAL)
+            with self._lock:
+                active = [self._batches[b] for b in self._active if b in self._batches]
+            for batch in active:
                 try:
-                    result = client.content_generation.tasks.get(task_id=task_id)
-                    if isinstance(result, dict):
-                        data = result
-                    else:
-                        try:
-                            data = json.loads(result.model_dump_json())
-                        except Exception:
-                            data = {
-                                "status": getattr(result, 'status', None),
-                                "content": getattr(result, 'content', None),
-                                "result": getattr(result, 'result', None),
-                            }
-                    status = (data or {}).get('status') or (data or {}).get('result', {}).get('status')
-                    if status == 'succeeded':
-                        return data
-                    if status == 'failed':
-                        return {"error": "Task failed", "details": data}
+                    self._pump(batch)
                 except Exception as e:
-                    last_err = e
+                    print(f"Batch {batch['batch_id']} dispatch failed: {e}")
+
+    def _pump(self, batch):
+        """统计在途条目并补交待处理条目直到达到并发上限；全部终结时将批次移出调度"""
+        with batch['lock']:
+            in_flight = 0
+            pending = []
+            for item in batch['items']:
+                if item['job_id']:
+                    job = job_manager.get(item['job_id'])
+                    if job and job['status'] not in FINAL_JOB_STATUSES:
+                        in_flight += 1
+                elif not item['error']:
+                    pending.append(item)
+            for item in pending:
+                if in_flight >= batch['concurrency']:
+                    break
+                cached_job = generation_cache.lookup(item['fingerprint']) if item['fingerprint'] else None
+                if cached_job:
+                    item.update(job_id=cached_job['job_id'], cached=True)
+                    if cached_job['status'] not in FINAL_JOB_STATUSES:
+                        in_flight += 1  # 复用仍在进行中的任务同样占用并发名额
                     continue
-            time.sleep(2)
-        return {"error": f"Task timeout. last_error={last_err}"}
-    except Exception as e:
-        return {"error": f"Polling error: {str(e)}"}
+                try:
+                    job = job_manager.submit(batch['api_key'], item['model'], item['image_urls'], item['params'])
+                except JobQueueFull:
+                    break  # 全局排队已满，下一轮再试
+                except Exception as e:
+                    item['error'] = str(e)
+                    continue
+                item['job_id'] = job['job_id']
+                in_flight += 1
+                if item['fingerprint']:
+                    generation_cache.remember(item['fingerprint'], job['job_id'])
+            if not pending and not in_flight:
+                with self._lock:
+                    self._active.discard(batch['batch_id'])
+                    batch['finished_at'] = batch['finished_at'] or time.time()
 
-def download_video(video_url, output_path):
-    """下载生成的视频"""
-    try:
-        response = requests.get(video_url, timeout=60)
-        response.raise_for_status()
-        
-        with open(output_path, 'wb') as f:
-            f.write(response.content)
-        
-        return True
-    except Exception as e:
-        print(f"Video download failed: {e}")
-        return False
+batch_manager = BatchManager(BATCH_HISTORY)
 
 @app.route('/')
 def index():
@@ -212,75 +3026,57 @@ def index():
 @app.route('/upload', methods=['POST'])
 def upload_files():
     """处理文件上传 - 支持首帧、尾帧和参考帧"""
-    uploaded_files = []
-    image_urls = []
+    upload_id = request.form.get('upload_id')
+    if upload_id and not valid_upload_id(upload_id):
+        return jsonify({'error': 'Invalid upload_id'}), 400
+    saved_files = []
     
-    # 处理首帧
-    if 'start_frame' in request.files:
-        start_file = request.files['start_frame']
-        if start_file and start_file.filename and allowed_file(start_file.filename):
-            filename = secure_filename(start_file.filename)
-            filename = f"start_{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            start_file.save(file_path)
-            
-            # 重新托管图片获取直接链接
-            rehosted_url = rehost_image(file_path)
-            if rehosted_url:
-                image_urls.append(rehosted_url)
-                uploaded_files.append({
-                    'type': 'start_frame',
-                    'filename': filename,
-                    'path': file_path,
-                    'url': rehosted_url
-                })
-    
-    # 处理尾帧
-    if 'end_frame' in request.files:
-        end_file = request.files['end_frame']
-        if end_file and end_file.filename and allowed_file(end_file.filename):
-            filename = secure_filename(end_file.filename)
-            filename = f"end_{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            end_file.save(file_path)
-            
-            # 重新托管图片获取直接链接
-            rehosted_url = rehost_image(file_path)
-            if rehosted_url:
-                image_urls.append(rehosted_url)
-                uploaded_files.append({
-                    'type': 'end_frame',
-                    'filename': filename,
-                    'path': file_path,
-                    'url': rehosted_url
-                })
-    
-    # 处理参考帧
-    if 'reference_frames' in request.files:
-        reference_files = request.files.getlist('reference_frames')
-        for i, ref_file in enumerate(reference_files):
-            if ref_file and ref_file.filename and allowed_file(ref_file.filename):
-                filename = secure_filename(ref_file.filename)
-                filename = f"ref_{i}_{uuid.uuid4().hex}_{filename}"
+    try:
+        # 处理首帧
+        if 'start_frame' in request.files:
+            start_file = request.files['start_frame']
+            if start_file and start_file.filename and allowed_file(start_file.filename):
+                filename = secure_filename(start_file.filename)
+                filename = f"start_{uuid.uuid4().hex}_{filename}"
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                saved_files.append(('start_frame', filename, file_path, ingest_upload(start_file, file_path)))
+    
+        # 处理尾帧
+        if 'end_frame' in request.files:
+            end_file = request.files['end_frame']
+            if end_file and end_file.filename and allowed_file(end_file.filename):
+                filename = secure_filename(end_file.filename)
+                filename = f"end_{uuid.uuid4().hex}_{filename}"
                 file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                ref_file.save(file_path)
-                
-                # 重新托管图片获取直接链接
-                rehosted_url = rehost_image(file_path)
-                if rehosted_url:
-                    image_urls.append(rehosted_url)
-                    uploaded_files.append({
-                        'type': 'reference_frame',
-                        'filename': filename,
-                        'path': file_path,
-                        'url': rehosted_url
-                    })
+                saved_files.append(('end_frame', filename, file_path, ingest_upload(end_file, file_path)))
+    
+        # 处理参考帧
+        if 'reference_frames' in request.files:
+            reference_files = request.files.getlist('reference_frames')
+            for i, ref_file in enumerate(reference_files):
+                if ref_file and ref_file.filename and allowed_file(ref_file.filename):
+                    filename = secure_filename(ref_file.filename)
+                    filename = f"ref_{i}_{uuid.uuid4().hex}_{filename}"
+                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                    saved_files.append(('reference_frame', filename, file_path, ingest_upload(ref_file, file_path)))
+    except InvalidUpload as e:
+        # 内容校验失败：在任何网络请求之前拒绝整个请求并清理已落盘的文件
+        discard_saved_files(saved_files)
+        return jsonify({'error': f'Invalid image file: {e}'}), 400
+    
+    # 预处理（纠正方向、缩小、去除元数据，不裁剪）后并行重新托管图片获取直接链接
+    saved_files = preprocess_saved_files(saved_files)
+    uploaded_files, image_urls = rehost_saved_files(saved_files)
     
     if not uploaded_files:
         return jsonify({'error': 'No valid images uploaded'}), 400
     
+    # 登记到上传索引，生成时按 upload_id 直接取图
+    upload_id = record_saved_files('frames', saved_files, upload_id)
+    
     return jsonify({
         'success': True,
+        'upload_id': upload_id,
         'files': uploaded_files,
         'image_urls': image_urls,
         'count': len(uploaded_files)
@@ -320,321 +3116,287 @@ def generate_video():
         return jsonify({'error': 'No image URLs provided'}), 400
     
     # 构建视频生成参数（含 seed / temperature）
-    # seed：-1 表示随机；0 或正整数表示固定种子
-    try:
-        seed_val = int(data.get('seed', -1))
-    except Exception:
-        seed_val = -1
-    if seed_val < -1:
-        seed_val = -1
-    try:
-        temperature_val = float(data.get('temperature', 0.7))
-    except Exception:
-        temperature_val = 0.7
-    if temperature_val < 0:
-        temperature_val = 0.0
-    if temperature_val > 1:
-        temperature_val = 1.0
-
-    video_params = {
-        'prompt': data.get('prompt', 'Generate a video based on the provided images'),
-        'ratio': data.get('ratio', '1092x1080'),
-        'duration': int(data.get('duration', 5)),
-        'fps': int(data.get('fps', 24)),
-        'watermark': data.get('watermark', False),
-        'seed': seed_val,
-        'temperature': temperature_val,
-    }
+    video_params = build_video_params(data, 'Generate a video based on the provided images')
     
     # 使用前端传入模型或默认 Seedance 模型ID（支持环境变量覆盖）
     model_name = data.get('model_name') or os.environ.get('ARK_DEFAULT_MODEL') or "seedance-1-0-lite-t2v-250428"
     
-    # 创建视频生成任务（SDK）
-    task_result = create_video_task(api_key, model_name, image_urls, **video_params)
-    
-    if 'error' in task_result:
-        # 若明确鉴权失败，返回 401，便于前端提示更准确
-        err_text = str(task_result['error'])
-        status_code = 401 if ('401' in err_text or 'Unauthorized' in err_text or 'AuthenticationError' in err_text) else 500
-        return jsonify({'error': f'Task creation failed: {task_result["error"]}'}), status_code
-    
-    task_id = task_result.get('id')
-    if not task_id:
-        return jsonify({'error': 'No task ID returned'}), 500
-    
-    # 轮询任务状态直到完成（SDK）
-    result = poll_task_status(api_key, task_id, max_wait_time=300)
-    
-    # 注意：部分 SDK/服务返回体可能包含 error: null（或 None），不能仅以存在键名判断为错误
-    if isinstance(result, dict) and result.get('error'):
-        return jsonify({'error': f'Task polling failed: {result.get("error")}'}), 500
-    
-    status = result.get('status') or result.get('result', {}).get('status')
-    content = result.get('content') or result.get('result', {}).get('content') or {}
-    video_url = (content or {}).get('video_url') or result.get('video_url') or result.get('result', {}).get('video_url')
-    if status == 'succeeded' and video_url:
-        output_filename = f"{task_id}.mp4"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        if download_video(video_url, output_path):
-            return jsonify({
-                'success': True,
-                'task_id': task_id,
-                'video_url': url_for('download_video_file', filename=output_filename, _external=True),
-                'message': 'Video generation completed successfully'
-            })
-        else:
-            return jsonify({'error': 'Failed to download video'}), 500
-    else:
-        return jsonify({'error': f'Task failed with status: {status or "unknown"}'}), 500
+    # 固定 seed 的相同请求直接复用已有任务/视频（no_cache=true 可跳过）
+    fingerprint = None if _cache_bypassed(data) else request_fingerprint(api_key, model_name, image_urls, video_params)
+    if fingerprint:
+        cached_job = generation_cache.lookup(fingerprint)
+        if cached_job:
+            return _cached_generation_response(cached_job, 'Reused cached video generation')
+    
+    # 提交到后台任务管理器，立即返回 job_id；创建/轮询/下载在后台完成
+    try:
+        job = job_manager.submit(api_key, model_name, image_urls, video_params)
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    if fingerprint:
+        generation_cache.remember(fingerprint, job['job_id'])
+
+    return jsonify({
+        'success': True,
+        'job_id': job['job_id'],
+        # 方舟 task_id 在后台创建后才可知；/status 与 /task_status 同时接受 job_id
+        'task_id': job['task_id'] or job['job_id'],
+        'status': job['status'],
+        'status_url': url_for('check_status', task_id=job['job_id'], _external=True),
+        'message': 'Video generation job accepted'
+    }), 202
 
 @app.route('/status/<task_id>')
 def check_status(task_id):
-    """检查任务状态"""
-    # 兼容前端不再传递 api_key：优先 query，其次环境变量
-    api_key = (request.args.get('api_key') or os.environ.get('ARK_API_KEY', '')).strip()
-    if not api_key:
-        return jsonify({'error': 'API key required (server is missing ARK_API_KEY)'}), 400
-
-    result = poll_task_status(api_key, task_id, max_wait_time=60)  # 限制为60秒
-
-    # 注意：同上，避免把 error: null 误判为错误
-    if isinstance(result, dict) and result.get('error'):
-        return jsonify({'error': result.get('error')}), 500
-
-    # 兼容不同SDK返回结构
-    status = result.get('status') or result.get('result', {}).get('status')
-    content = result.get('content') or result.get('result', {}).get('content') or {}
-    video_url = (content or {}).get('video_url') or result.get('video_url') or result.get('result', {}).get('video_url')
+    """检查任务状态（读取后台任务状态，不再在请求线程内轮询）"""
+    job = job_manager.get(task_id)
+    if job is None:
+        # 兼容前端不再传递 api_key：优先 query，其次环境变量
+        api_key = (request.args.get('api_key') or os.environ.get('ARK_API_KEY', '')).strip()
+        if not api_key:
+            return jsonify({'error': 'API key required (server is missing ARK_API_KEY)'}), 400
+        try:
+            job = job_manager.track(api_key, task_id)
+        except JobQueueFull as e:
+            return jsonify({'error': str(e)}), 503
 
     # 若成功，直接返回 200 和视频URL；若失败，返回 200 并给出状态由前端决定文案
-    if status == 'succeeded' and video_url:
+    if job['status'] == 'succeeded':
         # 优先返回本地代理下载地址，避免跨域或直链被浏览器拦截
-        output_filename = f"{task_id}.mp4"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-        local_url = url_for('download_video_file', filename=output_filename, _external=True)
-        try:
-            if not (os.path.exists(output_path) and os.path.getsize(output_path) > 0):
-                # 若文件不存在或为空，则尝试拉取一次
-                download_video(video_url, output_path)
-        except Exception:
-            pass
+        local_url = _job_local_url(job)
         # 若已成功落地，则返回本地URL；否则继续返回远端URL作兜底
-        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-            return jsonify({'status': 'succeeded', 'video_url': local_url, 'remote_url': video_url})
-        else:
-            return jsonify({'status': 'succeeded', 'video_url': video_url})
-    elif status == 'failed':
-        return jsonify({'status': 'failed', 'error': 'Task failed'})
+        if local_url:
+            return jsonify({'status': 'succeeded', 'video_url': local_url, 'remote_url': job['remote_url'],
+                            'polls': job.get('polls')})
+        return jsonify({'status': 'succeeded', 'video_url': job['remote_url'], 'polls': job.get('polls')})
+    elif job['status'] == 'failed':
+        return jsonify({'status': 'failed', 'error': job['error'] or 'Task failed', 'error_kind': job.get('error_kind'),
+                        'polls': job.get('polls')})
     else:
-        # 处理中或未知
-        return jsonify({'status': status or 'processing'})
-
-    if status == 'failed':
-        return jsonify({'status': 'failed', 'message': 'Task failed'}), 200
-
-    return jsonify({
-        'status': status or 'unknown',
-        'message': 'Task is still processing'
-    })
+        # 处理中或未知；方舟已成功但视频仍在下载时同样返回 processing（succeeded 必须带 video_url）
+        ark_status = job['ark_status']
+        return jsonify({'status': ark_status if ark_status and ark_status not in TERMINAL_STATUSES else 'processing'})
 
 @app.route('/task_status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
     """获取任务状态"""
-    api_key = os.environ.get('ARK_API_KEY', '').strip()
-    if not api_key:
-        return jsonify({'error': 'API key required'}), 400
-    
-    try:
-        result = poll_task_status(api_key, task_id, max_wait_time=1)
-        
-        if isinstance(result, dict) and result.get('error'):
-            error_msg = result.get('error', '')
-            # 处理方舟SDK的误导性错误信息
-            if 'API key doesn\'t exist' in error_msg or 'AuthenticationError' in error_msg:
-                # 这通常表示任务ID不存在，而不是API key问题
-                return jsonify({
-                    'status': 'failed', 
-                    'error': f'Task not found: {task_id}. Please check if the task ID is correct.',
-                    'progress': 0
-                })
-            return jsonify({'status': 'failed', 'error': error_msg, 'progress': 0})
-        
-        # 兼容不同SDK返回结构
-        status = result.get('status') or result.get('result', {}).get('status')
-        content = result.get('content') or result.get('result', {}).get('content') or {}
-        video_url = (content or {}).get('video_url') or result.get('video_url') or result.get('result', {}).get('video_url')
-        
-        if status == 'succeeded' and video_url:
-            # 返回本地代理下载地址
-            output_filename = f"{task_id}.mp4"
-            output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-            local_url = url_for('download_video_file', filename=output_filename, _external=True)
-            
-            try:
-                if not (os.path.exists(output_path) and os.path.getsize(output_path) > 0):
-                    download_video(video_url, output_path)
-            except Exception:
-                pass
-                
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                return jsonify({'status': 'completed', 'video_url': local_url, 'progress': 100})
-            else:
-                return jsonify({'status': 'completed', 'video_url': video_url, 'progress': 100})
-        elif status == 'failed':
-            return jsonify({'status': 'failed', 'error': 'Task failed', 'progress': 0})
-        else:
-            # 处理中，返回估算进度
-            progress = 50 if status == 'processing' else 25
-            return jsonify({'status': 'processing', 'progress': progress})
-            
-    except Exception as e:
-        error_msg = str(e)
-        # 处理方舟SDK的误导性错误信息
-        if 'API key doesn\'t exist' in error_msg or 'AuthenticationError' in error_msg:
-            return jsonify({
-                'status': 'failed', 
+    job = job_manager.get(task_id)
+    if job is None:
+        api_key = os.environ.get('ARK_API_KEY', '').strip()
+        if not api_key:
+            return jsonify({'error': 'API key required'}), 400
+        try:
+            job = job_manager.track(api_key, task_id)
+        except JobQueueFull as e:
+            return jsonify({'status': 'failed', 'error': str(e), 'progress': 0}), 503
+
+    return jsonify(_task_status_payload(task_id, job))
+
+def _task_status_payload(task_id, job):
+    """/task_status 与 SSE 共用的状态载荷：completed / failed / processing + progress"""
+    if job['status'] == 'succeeded':
+        # 返回本地代理下载地址
+        return {'status': 'completed', 'video_url': _job_local_url(job) or job['remote_url'], 'progress': 100,
+                'polls': job.get('polls')}
+    elif job['status'] == 'failed':
+        error_msg = job['error'] or 'Task failed'
+        # 查询不存在的任务时方舟返回 401（误导性的 "API key doesn't exist"），已归类为 not_found
+        if job.get('error_kind') == 'not_found' or 'API key doesn\'t exist' in error_msg:
+            # 这通常表示任务ID不存在，而不是API key问题
+            return {
+                'status': 'failed',
                 'error': f'Task not found: {task_id}. Please check if the task ID is correct.',
+                'error_kind': 'not_found',
                 'progress': 0
-            })
-        return jsonify({'status': 'failed', 'error': error_msg, 'progress': 0})
+            }
+        return {'status': 'failed', 'error': error_msg, 'error_kind': job.get('error_kind'), 'progress': 0,
+                'polls': job.get('polls')}
+    else:
+        # 处理中：按耗时模型中同画像的中位耗时估算进度，样本不足时退回固定估值
+        q = duration_model.quantiles(render_profile(job['model'], job['params'])) if job.get('model') else None
+        if q and job['ark_status'] == 'running':
+            progress = min(95, 25 + int(70 * (time.time() - job['created_at']) / q[1]))
+        else:
+            progress = 50 if job['ark_status'] == 'running' or job['status'] == 'downloading' else 25
+        return {'status': 'processing', 'progress': progress}
+
+# 新增：Server-Sent Events 推送任务状态，替代前端定时轮询
+SSE_HEARTBEAT = 15
+# 同步 WSGI 服务器上每个 SSE 连接独占一个工作线程直到任务结束；超过 SSE_MAX_STREAMS 时返回 503，
+# 前端回退为 /task_status 轮询。需要大量并发连接时请使用 gevent / eventlet 等异步 worker 并调高该值
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', '32'))
+sse_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+@app.route('/events/<task_id>')
+def task_events(task_id):
+    """单任务状态流"""
+    return _event_stream([task_id])
+
+@app.route('/events')
+def multi_task_events():
+    """多任务状态流：/events?ids=a,b,c"""
+    ids = [i.strip() for i in request.args.get('ids', '').split(',') if i.strip()]
+    if not ids:
+        return jsonify({'error': 'ids query parameter required'}), 400
+    return _event_stream(ids[:50])
+
+def _event_stream(task_ids):
+    api_key = (request.args.get('api_key') or os.environ.get('ARK_API_KEY', '')).strip()
+    for task_id in task_ids:
+        if job_manager.get(task_id) is None:
+            if not api_key:
+                return jsonify({'error': 'API key required'}), 400
+            try:
+                job_manager.track(api_key, task_id)
+            except JobQueueFull as e:
+                return jsonify({'error': str(e)}), 503
+    if not sse_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many event streams, poll /task_status instead'})
+        response.headers['Retry-After'] = str(SSE_HEARTBEAT)
+        return response, 503
+
+    def generate():
+        yield 'retry: 3000\n\n'
+        last_sent = {}
+        # 只订阅本连接关心的任务，其他任务的变化不会唤醒本连接
+        changed = task_events_bus.subscribe(task_ids)
+        try:
+            while True:
+                changed.clear()
+                pending = False
+                for task_id in task_ids:
+                    job = job_manager.get(task_id)
+                    if job is None:
+                        continue
+                    payload = dict(_task_status_payload(task_id, job), task_id=task_id)
+                    if payload != last_sent.get(task_id):
+                        last_sent[task_id] = payload
+                        yield f'event: status\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'
+                    if payload['status'] == 'processing':
+                        pending = True
+                if not pending:
+                    yield 'event: done\ndata: {}\n\n'
+                    return
+                if not changed.wait(SSE_HEARTBEAT):
+                    yield ': ping\n\n'
+        finally:
+            task_events_bus.unsubscribe(task_ids, changed)
+
+    response = app.response_class(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(sse_slots.release)
+    return response
 
 @app.route('/upload_firstlast', methods=['POST'])
 def upload_firstlast_files():
     """处理首尾帧上传"""
-    uploaded_files = []
-    image_urls = []
+    upload_id = request.form.get('upload_id')
+    if upload_id and not valid_upload_id(upload_id):
+        return jsonify({'error': 'Invalid upload_id'}), 400
+    saved_files = []
     
     # 确保firstlast子文件夹存在
     firstlast_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'firstlast')
     os.makedirs(firstlast_folder, exist_ok=True)
     
-    # 处理首帧（必需）
-    if 'first_frame' in request.files:
-        first_file = request.files['first_frame']
-        if first_file and first_file.filename and allowed_file(first_file.filename):
-            filename = secure_filename(first_file.filename)
-            filename = f"first_{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join(firstlast_folder, filename)
-            first_file.save(file_path)
-            
-            # 重新托管图片获取直接链接
-            rehosted_url = rehost_image(file_path)
-            if rehosted_url:
-                image_urls.append(rehosted_url)
-                uploaded_files.append({
-                    'type': 'first_frame',
-                    'filename': filename,
-                    'path': file_path,
-                    'url': rehosted_url
-                })
-    
-    # 处理尾帧（可选）
-    if 'last_frame' in request.files:
-        last_file = request.files['last_frame']
-        if last_file and last_file.filename and allowed_file(last_file.filename):
-            filename = secure_filename(last_file.filename)
-            filename = f"last_{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join(firstlast_folder, filename)
-            last_file.save(file_path)
-            
-            # 重新托管图片获取直接链接
-            rehosted_url = rehost_image(file_path)
-            if rehosted_url:
-                image_urls.append(rehosted_url)
-                uploaded_files.append({
-                    'type': 'last_frame',
-                    'filename': filename,
-                    'path': file_path,
-                    'url': rehosted_url
-                })
+    try:
+        # 处理首帧（必需）
+        if 'first_frame' in request.files:
+            first_file = request.files['first_frame']
+            if first_file and first_file.filename and allowed_file(first_file.filename):
+                filename = secure_filename(first_file.filename)
+                filename = f"first_{uuid.uuid4().hex}_{filename}"
+                file_path = os.path.join(firstlast_folder, filename)
+                saved_files.append(('first_frame', filename, file_path, ingest_upload(first_file, file_path)))
+    
+        # 处理尾帧（可选）
+        if 'last_frame' in request.files:
+            last_file = request.files['last_frame']
+            if last_file and last_file.filename and allowed_file(last_file.filename):
+                filename = secure_filename(last_file.filename)
+                filename = f"last_{uuid.uuid4().hex}_{filename}"
+                file_path = os.path.join(firstlast_folder, filename)
+                saved_files.append(('last_frame', filename, file_path, ingest_upload(last_file, file_path)))
+    except InvalidUpload as e:
+        # 内容校验失败：在任何网络请求之前拒绝整个请求并清理已落盘的文件
+        discard_saved_files(saved_files)
+        return jsonify({'error': f'Invalid image file: {e}'}), 400
+    
+    # 预处理（纠正方向、缩小、去除元数据，不裁剪）；生成时按 ratio 裁剪后才转存，这里不转存
+    saved_files = preprocess_saved_files(saved_files)
+    uploaded_files = saved_file_entries(saved_files)
     
     if not uploaded_files:
         return jsonify({'error': 'No valid images uploaded'}), 400
     
+    # 登记到上传索引，生成时按 upload_id 直接取图
+    upload_id = record_saved_files('firstlast', saved_files, upload_id)
+    
     return jsonify({
         'success': True,
+        'upload_id': upload_id,
         'files': uploaded_files,
-        'image_urls': image_urls,
         'count': len(uploaded_files)
     })
 
 @app.route('/upload_reference', methods=['POST'])
 def upload_reference_files():
     """处理参考图上传"""
-    uploaded_files = []
-    image_urls = []
+    upload_id = request.form.get('upload_id')
+    if upload_id and not valid_upload_id(upload_id):
+        return jsonify({'error': 'Invalid upload_id'}), 400
+    saved_files = []
     
     # 确保reference子文件夹存在
     reference_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'reference')
     os.makedirs(reference_folder, exist_ok=True)
     
-    # 处理参考图（1-4张）
-    if 'reference_images' in request.files:
-        reference_files = request.files.getlist('reference_images')
+    # 先按请求中的文件数校验上限，超出时在读取内容和任何网络请求之前拒绝
+    reference_files = [f for f in request.files.getlist('reference_images')
+                       if f and f.filename and allowed_file(f.filename)]
+    if len(reference_files) > 4:
+        return jsonify({'error': 'Maximum 4 reference images allowed'}), 400
+    
+    try:
+        # 处理参考图（1-4张）
         for i, ref_file in enumerate(reference_files):
-            if ref_file and ref_file.filename and allowed_file(ref_file.filename):
-                filename = secure_filename(ref_file.filename)
-                filename = f"ref_{i}_{uuid.uuid4().hex}_{filename}"
-                file_path = os.path.join(reference_folder, filename)
-                ref_file.save(file_path)
-                
-                # 重新托管图片获取直接链接
-                rehosted_url = rehost_image(file_path)
-                if rehosted_url:
-                    image_urls.append(rehosted_url)
-                    uploaded_files.append({
-                        'type': 'reference_image',
-                        'filename': filename,
-                        'path': file_path,
-                        'url': rehosted_url
-                    })
+            filename = secure_filename(ref_file.filename)
+            filename = f"ref_{i}_{uuid.uuid4().hex}_{filename}"
+            file_path = os.path.join(reference_folder, filename)
+            saved_files.append(('reference_image', filename, file_path, ingest_upload(ref_file, file_path)))
+    except InvalidUpload as e:
+        # 内容校验失败：在任何网络请求之前拒绝整个请求并清理已落盘的文件
+        discard_saved_files(saved_files)
+        return jsonify({'error': f'Invalid image file: {e}'}), 400
+    
+    # 预处理（纠正方向、缩小、去除元数据，不裁剪）；生成时按 ratio 裁剪后才转存，这里不转存
+    saved_files = preprocess_saved_files(saved_files)
+    uploaded_files = saved_file_entries(saved_files)
     
     if not uploaded_files:
         return jsonify({'error': 'No valid reference images uploaded'}), 400
     
-    if len(uploaded_files) > 4:
-        return jsonify({'error': 'Maximum 4 reference images allowed'}), 400
+    # 登记到上传索引，生成时按 upload_id 直接取图
+    upload_id = record_saved_files('reference', saved_files, upload_id)
     
     return jsonify({
         'success': True,
+        'upload_id': upload_id,
         'files': uploaded_files,
-        'image_urls': image_urls,
         'count': len(uploaded_files)
     })
 
 @app.route('/generate_firstlast', methods=['POST'])
 def generate_firstlast_video():
     """生成首尾帧视频"""
-    # 检查是否有已上传的首尾帧图片
-    first_frame_files = []
-    last_frame_files = []
-    
-    firstlast_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'firstlast')
-    if os.path.exists(firstlast_folder):
-        for filename in os.listdir(firstlast_folder):
-            if filename.startswith('first_') and allowed_file(filename):
-                first_frame_files.append(filename)
-            elif filename.startswith('last_') and allowed_file(filename):
-                last_frame_files.append(filename)
-    
-    # 处理首帧（必需）
-    image_urls = []
-    if first_frame_files:
-        # 取最新的首帧文件
-        latest_first = sorted(first_frame_files)[-1]
-        file_path = os.path.join(firstlast_folder, latest_first)
-        rehosted_url = rehost_image(file_path)
-        if rehosted_url:
-            image_urls.append(rehosted_url)
-    
-    # 处理尾帧（可选）
-    if last_frame_files:
-        # 取最新的尾帧文件
-        latest_last = sorted(last_frame_files)[-1]
-        file_path = os.path.join(firstlast_folder, latest_last)
-        rehosted_url = rehost_image(file_path)
-        if rehosted_url:
-            image_urls.append(rehosted_url)
+    # 按 upload_id 从上传索引取首帧（必需）+ 尾帧（可选），未携带时取最近一次首尾帧上传
+    frame_paths, error = resolve_upload_paths('firstlast', _request_upload_id(), types=('first_frame', 'last_frame'))
+    if error:
+        return jsonify({'error': error}), 404
+    data = request.get_json(silent=True) or {}
+    # 按本次 ratio 裁剪后转存（上传时只做方向纠正与缩小）
+    image_urls = [url for url in rehost_images(crop_to_ratio(frame_paths, data.get('ratio', DEFAULT_RATIO))) if url]
     
     if not image_urls:
         return jsonify({'error': 'No valid images found. Please upload first frame image.'}), 400
@@ -644,75 +3406,48 @@ def generate_firstlast_video():
     if not api_key:
         return jsonify({'error': 'API key required'}), 400
     
-    # 获取JSON参数
-    data = request.get_json() or {}
-    
     # 构建视频生成参数
-    try:
-        seed_val = int(data.get('seed', -1))
-    except Exception:
-        seed_val = -1
-    if seed_val < -1:
-        seed_val = -1
-        
-    try:
-        temperature_val = float(data.get('temperature', 0.7))
-    except Exception:
-        temperature_val = 0.7
-    if temperature_val < 0:
-        temperature_val = 0.0
-    if temperature_val > 1:
-        temperature_val = 1.0
-    
-    video_params = {
-        'prompt': data.get('prompt', 'Generate a video from first frame to last frame'),
-        'ratio': data.get('ratio', '1092x1080'),
-        'duration': int(data.get('duration', 5)),
-        'fps': int(data.get('fps', 24)),
-        'watermark': data.get('watermark', False),
-        'seed': seed_val,
-        'temperature': temperature_val,
-    }
+    video_params = build_video_params(data, 'Generate a video from first frame to last frame')
     
     model_name = data.get('model_name') or "seedance-1-0-lite-i2v-250428"
     
-    # 创建视频生成任务
-    task_result = create_video_task(api_key, model_name, image_urls, **video_params)
-    
-    if 'error' in task_result:
-        return jsonify({'error': f'Task creation failed: {task_result["error"]}'}), 500
+    # 固定 seed 的相同请求直接复用已有任务/视频（no_cache=true 可跳过）
+    fingerprint = None if _cache_bypassed(data) else request_fingerprint(api_key, model_name, image_urls, video_params)
+    if fingerprint:
+        cached_job = generation_cache.lookup(fingerprint)
+        if cached_job:
+            return _cached_generation_response(cached_job, 'Reused cached video generation')
     
-    task_id = task_result.get('id')
-    if not task_id:
-        return jsonify({'error': 'No task ID returned'}), 500
+    # 提交到后台任务管理器，立即返回 job_id；创建（含限流等待）/轮询/下载在后台完成
+    try:
+        job = job_manager.submit(api_key, model_name, image_urls, video_params)
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    if fingerprint:
+        generation_cache.remember(fingerprint, job['job_id'])
     
     return jsonify({
         'success': True,
-        'task_id': task_id,
-        'message': 'First-last frame video generation started'
-    })
+        'job_id': job['job_id'],
+        'task_id': job['task_id'] or job['job_id'],
+        'status': job['status'],
+        'status_url': url_for('check_status', task_id=job['job_id'], _external=True),
+        'message': 'First-last frame video generation accepted'
+    }), 202
 
 @app.route('/generate_reference', methods=['POST'])
 def generate_reference_video():
     """生成参考图视频"""
-    # 检查是否有已上传的参考图
-    reference_image_files = []
-    reference_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'reference')
-    if os.path.exists(reference_folder):
-        for filename in os.listdir(reference_folder):
-            if filename.startswith('ref_') and allowed_file(filename):
-                reference_image_files.append(filename)
-    
-    if not reference_image_files:
+    # 按 upload_id 从上传索引取参考图（最多 4 张），未携带时取最近一次参考图上传
+    reference_paths, error = resolve_upload_paths('reference', _request_upload_id(), limit=4)
+    if error:
+        return jsonify({'error': error}), 404
+    if not reference_paths:
         return jsonify({'error': 'No valid reference images found. Please upload images first.'}), 400
     
-    # 重新托管最新的参考图
-    image_urls = []
-    for filename in sorted(reference_image_files)[-4:]:  # 取最新的4张图
-        file_path = os.path.join(reference_folder, filename)
-        rehosted_url = rehost_image(file_path)
-        if rehosted_url:
-            image_urls.append(rehosted_url)
+    # 按本次 ratio 裁剪后重新托管参考图（上传时只做方向纠正与缩小）
+    data = request.get_json(silent=True) or {}
+    image_urls = [url for url in rehost_images(crop_to_ratio(reference_paths, data.get('ratio', DEFAULT_RATIO))) if url]
     
     if not image_urls:
         return jsonify({'error': 'No valid reference images could be processed'}), 400
@@ -722,62 +3457,252 @@ def generate_reference_video():
     if not api_key:
         return jsonify({'error': 'API key required'}), 400
     
-    # 获取JSON参数
-    data = request.get_json() or {}
-    
     # 构建视频生成参数
-    try:
-        seed_val = int(data.get('seed', -1))
-    except Exception:
-        seed_val = -1
-    if seed_val < -1:
-        seed_val = -1
-        
-    try:
-        temperature_val = float(data.get('temperature', 0.7))
-    except Exception:
-        temperature_val = 0.7
-    if temperature_val < 0:
-        temperature_val = 0.0
-    if temperature_val > 1:
-        temperature_val = 1.0
-    
-    video_params = {
-        'prompt': data.get('prompt', 'Generate a video based on the provided reference images'),
-        'ratio': data.get('ratio', '1092x1080'),
-        'duration': int(data.get('duration', 5)),
-        'fps': int(data.get('fps', 24)),
-        'watermark': data.get('watermark', False),
-        'seed': seed_val,
-        'temperature': temperature_val,
-    }
+    video_params = build_video_params(data, 'Generate a video based on the provided reference images')
     
     model_name = data.get('model_name') or "seedance-1-0-lite-i2v-250428"
     
-    # 创建视频生成任务
-    task_result = create_video_task(api_key, model_name, image_urls, **video_params)
+    # 固定 seed 的相同请求直接复用已有任务/视频（no_cache=true 可跳过）
+    fingerprint = None if _cache_bypassed(data) else request_fingerprint(api_key, model_name, image_urls, video_params)
+    if fingerprint:
+        cached_job = generation_cache.lookup(fingerprint)
+        if cached_job:
+            return _cached_generation_response(cached_job, 'Reused cached video generation')
     
-    if 'error' in task_result:
-        return jsonify({'error': f'Task creation failed: {task_result["error"]}'}), 500
-    
-    task_id = task_result.get('id')
-    if not task_id:
-        return jsonify({'error': 'No task ID returned'}), 500
+    # 提交到后台任务管理器，立即返回 job_id；创建（含限流等待）/轮询/下载在后台完成
+    try:
+        job = job_manager.submit(api_key, model_name, image_urls, video_params)
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    if fingerprint:
+        generation_cache.remember(fingerprint, job['job_id'])
     
     return jsonify({
         'success': True,
-        'task_id': task_id,
-        'message': 'Reference image video generation started'
+        'job_id': job['job_id'],
+        'task_id': job['task_id'] or job['job_id'],
+        'status': job['status'],
+        'status_url': url_for('check_status', task_id=job['job_id'], _external=True),
+        'message': 'Reference image video generation accepted'
+    }), 202
+
+@app.route('/local_rehost/<filename>')
+def local_rehost_file(filename):
+    """本地替身图床的文件访问"""
+    file_path = os.path.join(LOCAL_REHOST_FOLDER, secure_filename(filename))
+    if os.path.exists(file_path):
+        mark_served(file_path)
+        return send_file(file_path)
+    return jsonify({'error': 'File not found'}), 404
+
+@app.route('/uploads/<path:filename>')
+def signed_upload_file(filename):
+    """签名直链访问 uploads/ 下的图片（供方舟拉取），签名无效或已过期返回 403"""
+    remaining = verify_signed_upload(filename, request.args.get('expires'), request.args.get('sig'))
+    if remaining is None:
+        return jsonify({'error': 'Invalid or expired signature'}), 403
+    file_path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+    if not file_path or not os.path.isfile(file_path):
+        return jsonify({'error': 'File not found'}), 404
+    mark_served(file_path)
+    response = send_file(file_path, mimetype=mimetypes.guess_type(file_path)[0] or 'application/octet-stream',
+                         conditional=True, max_age=remaining)
+    # 上传文件名含 uuid，内容不变；缓存时长不超过签名剩余有效期
+    response.headers['Cache-Control'] = f'public, max-age={remaining}, immutable'
+    return response
+
+@app.route('/batch', methods=['POST'])
+def create_batch():
+    """批量生成：{"items": [{"image_urls": [...], "prompt": ...}, ...], "concurrency": 4, ...}。
+    批次级字段（model_name / prompt / ratio / duration / fps / seed ...）作为各条目的默认值；立即返回 batch_id"""
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Missing required field: items'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Maximum {BATCH_MAX_ITEMS} items per batch'}), 400
+
+    api_key = str(data.get('api_key', '')).strip()
+    if api_key.lower().startswith('bearer '):
+        api_key = api_key[7:].strip()
+    api_key = api_key or os.environ.get('ARK_API_KEY', '').strip()
+    if not api_key:
+        return jsonify({'error': 'API key required'}), 400
+
+    try:
+        concurrency = max(1, min(int(data.get('concurrency', BATCH_CONCURRENCY)), BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        concurrency = BATCH_CONCURRENCY
+
+    defaults = {k: v for k, v in data.items() if k not in ('items', 'api_key', 'concurrency')}
+    batch_items = []
+    for i, raw in enumerate(items):
+        if not isinstance(raw, dict):
+            return jsonify({'error': f'Item {i} must be an object'}), 400
+        item = dict(defaults, **raw)
+        image_urls = item.get('image_urls')
+        if not isinstance(image_urls, list) or not image_urls:
+            return jsonify({'error': f'Item {i}: no image URLs provided'}), 400
+        try:
+            video_params = build_video_params(item, 'Generate a video based on the provided images')
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': f'Item {i}: invalid parameters: {e}'}), 400
+        model_name = item.get('model_name') or os.environ.get('ARK_DEFAULT_MODEL') or "seedance-1-0-lite-t2v-250428"
+        batch_items.append({
+            'model': model_name,
+            'image_urls': image_urls,
+            'params': video_params,
+            'fingerprint': None if _cache_bypassed(item) else request_fingerprint(api_key, model_name, image_urls, video_params),
+        })
+
+    batch_id = batch_manager.submit(api_key, batch_items, concurrency)
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'total': len(batch_items),
+        'concurrency': concurrency,
+        'status_url': url_for('get_batch', batch_id=batch_id, _external=True),
+    }), 202
+
+@app.route('/batch/<batch_id>')
+def get_batch(batch_id):
+    """批次汇总进度与各条目结果"""
+    batch = batch_manager.get(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify(batch)
+
+@app.route('/callbacks/ark', methods=['POST'])
+def ark_task_callback():
+    """方舟任务状态回调：校验 token / 签名后按一次轮询结果更新任务，成功时触发视频下载；重复投递幂等"""
+    body = request.get_data(cache=True)
+    if not verify_callback(request, body):
+        callback_dedup.reject()
+        return jsonify({'error': 'Invalid callback signature'}), 403
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        return jsonify({'error': 'Invalid JSON body'}), 400
+    task_id = data.get('id') or data.get('task_id') if isinstance(data, dict) else None
+    status, _ = _extract_result(data) if task_id else (None, None)
+    if not task_id or not status:
+        return jsonify({'error': 'Missing task id or status'}), 400
+
+    event = (task_id, status, data.get('updated_at'))
+    if callback_dedup.seen(event):
+        return jsonify({'success': True, 'duplicate': True})
+    if task_poller.push(task_id, data):
+        callback_dedup.mark(event)
+        return jsonify({'success': True, 'handled': True})
+    job = job_manager.get(task_id)
+    if job is None:
+        # 本进程未在跟踪（如重启后）：登记跟踪，轮询器会立即查询一次并走正常下载流程
+        api_key = os.environ.get('ARK_API_KEY', '').strip()
+        if api_key:
+            try:
+                job_manager.track(api_key, task_id)
+            except JobQueueFull as e:
+                # 返回 503 让方舟稍后重试回调，而不是静默丢弃
+                return jsonify({'error': str(e)}), 503
+    callback_dedup.mark(event)
+    return jsonify({'success': True, 'handled': False})
+
+@app.route('/tasks')
+def list_tasks():
+    """任务列表：/tasks?status=succeeded&limit=50&cursor=...（按创建时间倒序，游标分页）"""
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 500))
+    except ValueError:
+        limit = 50
+    before = None
+    cursor = request.args.get('cursor', '')
+    if cursor:
+        created_at, _, task_id = cursor.partition(':')
+        try:
+            before = (float(created_at), task_id)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    rows = task_store.list(status=request.args.get('status') or None, limit=limit, before=before)
+    next_cursor = f"{rows[-1]['created_at']!r}:{rows[-1]['task_id']}" if len(rows) == limit else None
+    return jsonify({'tasks': rows, 'count': len(rows), 'next_cursor': next_cursor})
+
+@app.route('/stats')
+def service_stats():
+    """运行时统计：客户端缓存命中/连接池饱和、地域健康度、转存缓存、后台任务与轮询器规模、磁盘清理"""
+    return jsonify({
+        'ark_clients': ark_clients.stats(),
+        'regions': region_router.stats(),
+        'ark_limits': ark_limiter.stats(),
+        'rehost_cache': rehost_cache.stats(),
+        'rehost_providers': provider_registry.stats(),
+        'downloads': download_flights.stats(),
+        'generation_cache': generation_cache.stats(),
+        'uploads': upload_index.stats(),
+        'janitor': janitor.stats(),
+        'jobs': job_manager.stats(),
+        'batches': batch_manager.stats(),
+        'callbacks': callback_dedup.stats(),
+        'poller': task_poller.stats(),
+        'events': task_events_bus.stats(),
+        'duration_model': duration_model.stats(),
     })
 
+# 抓取时计算的指标：目录占用取自 janitor（超过 METRICS_DISK_TTL 未统计时重新扫描），其余取自各组件 stats()
+metrics.collected('imagetest_disk_usage_bytes', 'Bytes stored under uploads/ and outputs/.',
+                  lambda: {(name,): usage[1] for name, usage in janitor.usage(METRICS_DISK_TTL).items()}, ('folder',))
+metrics.collected('imagetest_disk_files', 'Files stored under uploads/ and outputs/.',
+                  lambda: {(name,): usage[0] for name, usage in janitor.usage(METRICS_DISK_TTL).items()}, ('folder',))
+metrics.collected('imagetest_janitor_evicted_bytes_total', 'Bytes reclaimed by the janitor.',
+                  lambda: {(name,): c['bytes_reclaimed'] for name, c in janitor.stats().items()}, ('folder',), kind='counter')
+metrics.collected('imagetest_poller_active_tasks', 'Ark tasks currently scheduled for polling.',
+                  lambda: {(): task_poller.active_count()})
+metrics.collected('imagetest_jobs_pending', 'Jobs queued or running on the job worker pool.',
+                  lambda: {(): job_manager.stats()['pending']})
+metrics.collected('imagetest_callbacks_total', 'Ark callbacks received, by result.',
+                  lambda: {(key,): value for key, value in callback_dedup.stats().items() if key != 'enabled'},
+                  ('result',), kind='counter')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 文本格式指标（上传、转存、方舟调用、轮询、渲染、下载、磁盘占用）"""
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+# 新增：视频下载的缓存/卸载配置。任务输出按 task_id 命名且落地后不再变化，可长期缓存；
+# 设置 X_ACCEL_REDIRECT_PREFIX（nginx internal location）或 USE_X_SENDFILE（Apache/lighttpd）后由前置服务器直接发送文件
+OUTPUT_CACHE_MAX_AGE = int(os.environ.get('OUTPUT_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+
 @app.route('/download/<filename>')
 def download_video_file(filename):
-    """下载生成的视频文件"""
-    file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
-    else:
+    """下载生成的视频文件（支持 Range/206 拖动播放、ETag/Last-Modified 条件请求 304）"""
+    file_path = safe_join(app.config['OUTPUT_FOLDER'], filename)
+    if not file_path or not os.path.isfile(file_path):
         return jsonify({'error': 'File not found'}), 404
 
+    st = os.stat(file_path)
+    mark_served(file_path, st)
+    etag = f"{os.path.splitext(filename)[0]}-{st.st_size}-{int(st.st_mtime)}"
+    if X_ACCEL_REDIRECT_PREFIX:
+        response = make_response('')
+        response.set_etag(etag)
+        response.last_modified = st.st_mtime
+        # 与直接发送一致：If-None-Match / If-Modified-Since 命中时直接 304，不再交给前置服务器
+        response.make_conditional(request)
+        if response.status_code != 304:
+            response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + filename
+            response.headers['Content-Type'] = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    else:
+        # conditional=True 时 werkzeug 处理 Range 与 If-None-Match/If-Modified-Since；
+        # 文件体通过 wsgi.file_wrapper 发送，服务器支持时走 sendfile 零拷贝
+        response = send_file(file_path, as_attachment=True, conditional=True, etag=etag,
+                             last_modified=st.st_mtime, max_age=OUTPUT_CACHE_MAX_AGE)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = f'public, max-age={OUTPUT_CACHE_MAX_AGE}, immutable'
+    return response
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -26,12 +26,15 @@ import os
 import time
 import json
 import sys
+import random
 from typing import List, Optional
 
 import requests
 import argparse
 import tempfile
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from urllib.parse import urlparse, urlunparse, urlencode, parse_qsl
 
 BASE_URL = os.environ.get("ARK_BASE_URL", "https://ark.ap-southeast.bytepluses.com/api/v3")
@@ -117,24 +120,39 @@ def get_task(api_key: str, task_id: str) -> dict:
     return resp.json()
 
 
-def poll_task_until_done(api_key: str, task_id: str, interval: int = 8, timeout_sec: int = 30 * 60) -> dict:
+def next_poll_interval(elapsed: float, expected_sec: float, min_interval: float = 3, max_interval: float = 30) -> float:
+    """按预计耗时安排轮询：预计完成前 70% 的时间里每次等待剩余时间的一半（稀疏），
+    预计完成附近（70%~150%）按最小间隔密集查询，之后逐步放缓；加 ±20% 抖动。"""
+    if elapsed < 0.7 * expected_sec:
+        interval = min(max_interval, max(min_interval, (0.7 * expected_sec - elapsed) / 2))
+    elif elapsed <= 1.5 * expected_sec:
+        interval = min_interval
+    else:
+        interval = min(max_interval, min_interval * (elapsed / (1.5 * expected_sec)) ** 2)
+    return interval * random.uniform(0.8, 1.2)
+
+
+def poll_task_until_done(api_key: str, task_id: str, expected_sec: float = 150, timeout_sec: int = 30 * 60) -> dict:
     """轮询任务状态直到 succeeded/failed 或超时，返回最终响应 JSON。"""
     t0 = time.time()
     last_status = None
+    polls = 0
     while True:
         data = get_task(api_key, task_id)
+        polls += 1
         status = data.get("status") or data.get("result", {}).get("status")
         if status != last_status:
             print(f"任务状态: {status}")
             last_status = status
 
         if status in {"succeeded", "failed"}:
+            print(f"共查询 {polls} 次，耗时 {time.time() - t0:.0f} 秒")
             return data
 
         if time.time() - t0 > timeout_sec:
             raise TimeoutError("轮询超时")
 
-        time.sleep(interval)
+        time.sleep(next_poll_interval(time.time() - t0, expected_sec))
 
 
 def ensure_dir(path: str):
@@ -263,9 +281,58 @@ def upload_to_0x0(file_path: str) -> str:
     return url
 
 
-def rehost_images(images: List[str], method: str) -> List[str]:
+def upload_hedged(local_path: str, uploaders: List[tuple], hedge_delay: float) -> str:
+    """对冲上传：先启动第一个图床，hedge_delay 秒内未成功（或已失败）即启动下一个，取第一个有效链接。
+    胜出后取消尚未开始的尝试；已在途的请求无法中断，结果丢弃。打印各图床耗时与胜出者。
+    """
+    cancelled = threading.Event()
+
+    def attempt(name, upload):
+        if cancelled.is_set():
+            raise RuntimeError("cancelled")
+        t0 = time.time()
+        try:
+            return name, upload(local_path), time.time() - t0
+        except Exception as e:
+            print(f"  {name} 失败（{time.time() - t0:.1f}s）: {e}")
+            raise
+
+    pool = ThreadPoolExecutor(max_workers=len(uploaders))
+    pending = set()
+    last_err: Optional[Exception] = None
+    idx = 0
+    try:
+        while idx < len(uploaders) or pending:
+            if idx < len(uploaders) and (not pending or hedge_delay == 0):
+                pending.add(pool.submit(attempt, *uploaders[idx]))
+                idx += 1
+                continue
+            done, pending = wait(pending, timeout=hedge_delay if idx < len(uploaders) else None,
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                pending.add(pool.submit(attempt, *uploaders[idx]))
+                idx += 1
+                continue
+            for fut in done:
+                try:
+                    name, url, elapsed = fut.result()
+                except Exception as e:
+                    last_err = e
+                    continue
+                cancelled.set()
+                for other in pending:
+                    other.cancel()
+                print(f"  {name} 胜出（{elapsed:.1f}s）")
+                return url
+    finally:
+        pool.shutdown(wait=False)
+    raise RuntimeError(f"所有图床上传失败: {local_path} -> {last_err}")
+
+
+def rehost_images(images: List[str], method: str, hedge_delay: Optional[float] = None) -> List[str]:
     """将本地路径或非直链 URL 统一处理为可直连的 image/* 链接。
     method: "transfer.sh" | "catbox" | "0x0" | "auto"
+    hedge_delay: 仅 auto 模式有效；设置后各图床按对冲方式竞速，而不是逐个等待超时。
     """
     if method in {"none", None}:  # 不处理
         return images
@@ -284,6 +351,14 @@ def rehost_images(images: List[str], method: str) -> List[str]:
                 if not os.path.isfile(local_path):
                     raise FileNotFoundError(f"本地文件不存在: {local_path}")
 
+            if method == "auto" and hedge_delay is not None:
+                output_urls.append(upload_hedged(local_path, [
+                    ("transfer.sh", upload_to_transfersh),
+                    ("catbox", upload_to_catbox),
+                    ("0x0", upload_to_0x0),
+                ], hedge_delay))
+                continue
+
             last_err = None
             if method in {"transfer.sh", "auto"}:
                 try:
@@ -347,6 +422,18 @@ def main():
         default="none",
         help="输入为本地或非直链时，是否转存获取直链：none(默认)/transfer.sh/catbox/0x0/auto(自动降级)"
     )
+    parser.add_argument(
+        "--expected-secs",
+        type=float,
+        default=None,
+        help="预计渲染耗时（秒），用于安排轮询节奏；默认按视频时长粗略估计（每秒视频约 30 秒）"
+    )
+    parser.add_argument(
+        "--hedge-delay",
+        type=float,
+        default=None,
+        help="auto 模式下启用对冲上传：首选图床超过该秒数未返回即并行启动下一个（0 表示同时竞速）"
+    )
     args = parser.parse_args()
 
     refs = args.images
@@ -356,7 +443,7 @@ def main():
     if args.rehost != "none":
         print(f"启用临时托管: {args.rehost}，开始处理输入文件...")
         try:
-            refs = rehost_images(refs, method=args.rehost)
+            refs = rehost_images(refs, method=args.rehost, hedge_delay=args.hedge_delay)
         except Exception as e:
             print(f"临时托管处理失败: {e}")
             sys.exit(1)
@@ -380,7 +467,7 @@ def main():
 
     print("开始轮询任务进度...")
     try:
-        final_data = poll_task_until_done(api_key, task_id)
+        final_data = poll_task_until_done(api_key, task_id, expected_sec=args.expected_secs or args.dur * 30)
     except Exception as e:
         print(f"轮询失败: {e}")
         sys.exit(3)
@@ -12,8 +12,15 @@ let uploadedImages = {
     }
 };
 
+// 服务端返回的上传批次 id，生成时据此取图
+let uploadIds = {
+    firstlast: null,
+    reference: null
+};
+
 let currentTaskId = null;
 let progressInterval = null;
+let progressSource = null;
 
 // DOM 加载完成后初始化
 document.addEventListener('DOMContentLoaded', function() {
@@ -165,6 +172,7 @@ function handleImageFile(file, mode, imageKey, previewElement) {
 
 // 清空图片
 function clearImages(mode) {
+    uploadIds[mode] = null;
     if (mode === 'firstlast') {
         uploadedImages.firstlast.startFrame = null;
         uploadedImages.firstlast.endFrame = null;
@@ -223,6 +231,7 @@ async function uploadImages(mode) {
         const result = await response.json();
         
         if (result.success) {
+            uploadIds[mode] = result.upload_id;
             showToast('图片上传成功', 'success');
             updateButtonStates(mode);
         } else {
@@ -246,6 +255,9 @@ async function generateVideo(mode) {
     
     try {
         const endpoint = mode === 'firstlast' ? '/generate_firstlast' : '/generate_reference';
+        if (uploadIds[mode]) {
+            config.upload_id = uploadIds[mode];
+        }
         const response = await fetch(endpoint, {
             method: 'POST',
             headers: {
@@ -312,33 +324,75 @@ function showProgress(mode) {
     }
 }
 
-// 开始进度轮询
+// 开始进度监听：优先使用 SSE 由服务端推送状态，不支持时回退为定时轮询
 function startProgressPolling(mode) {
     if (progressInterval) {
         clearInterval(progressInterval);
+        progressInterval = null;
+    }
+    if (progressSource) {
+        progressSource.close();
+        progressSource = null;
+    }
+    
+    if (window.EventSource) {
+        progressSource = new EventSource(`/events/${currentTaskId}`);
+        progressSource.addEventListener('status', (event) => {
+            handleProgressResult(mode, JSON.parse(event.data));
+        });
+        progressSource.addEventListener('done', () => {
+            progressSource.close();
+            progressSource = null;
+        });
+        progressSource.addEventListener('error', () => {
+            // 服务端拒绝连接（如 SSE 连接数已满返回 503）时 EventSource 不再重连，回退为轮询
+            if (progressSource && progressSource.readyState === EventSource.CLOSED) {
+                progressSource = null;
+                pollProgress(mode);
+            }
+        });
+        return;
     }
     
+    pollProgress(mode);
+}
+
+// 定时轮询任务状态
+function pollProgress(mode) {
     progressInterval = setInterval(async () => {
         try {
             const response = await fetch(`/task_status/${currentTaskId}`);
             const result = await response.json();
-            
-            updateProgress(mode, result.progress, result.status);
-            
-            if (result.status === 'completed') {
-                clearInterval(progressInterval);
-                showResult(mode, result.video_url);
-            } else if (result.status === 'failed') {
-                clearInterval(progressInterval);
-                showToast(`生成失败: ${result.error}`, 'error');
-                hideProgress(mode);
-            }
+            handleProgressResult(mode, result);
         } catch (error) {
             console.error('Progress polling error:', error);
         }
     }, 2000);
 }
 
+// 处理一次任务状态（SSE 推送与轮询共用）
+function handleProgressResult(mode, result) {
+    updateProgress(mode, result.progress, result.status);
+    
+    if (result.status === 'completed' || result.status === 'failed') {
+        if (progressInterval) {
+            clearInterval(progressInterval);
+            progressInterval = null;
+        }
+        if (progressSource) {
+            progressSource.close();
+            progressSource = null;
+        }
+    }
+    
+    if (result.status === 'completed') {
+        showResult(mode, result.video_url);
+    } else if (result.status === 'failed') {
+        showToast(`生成失败: ${result.error}`, 'error');
+        hideProgress(mode);
+    }
+}
+
 // 更新进度
 function updateProgress(mode, progress, status) {
     const progressFill = document.getElementById(`${mode}ProgressFill`);
@@ -36,6 +36,9 @@ document.addEventListener('DOMContentLoaded', function() {
 let firstFrameFile = null;
 let lastFrameFile = null;
 let referenceFiles = [];
+// 服务端返回的上传批次 id，生成时据此取图
+let firstLastUploadId = null;
+let referenceUploadId = null;
 
 // 首尾帧模式的图片上传处理
 function setupFirstLastUpload() {
@@ -235,6 +238,7 @@ function updateReferenceUploadButton() {
 
 // 清空首尾帧图片
 function clearFirstLastImages() {
+    firstLastUploadId = null;
     firstFrameFile = null;
     lastFrameFile = null;
     document.getElementById('startFramePreview').style.display = 'none';
@@ -246,6 +250,7 @@ function clearFirstLastImages() {
 
 // 清空参考图
 function clearReferenceImages() {
+    referenceUploadId = null;
     referenceFiles = [];
     document.getElementById('referenceFramesPreview').style.display = 'none';
     document.getElementById('referenceFramesInput').value = '';
@@ -273,6 +278,7 @@ async function uploadFirstLastImages() {
         
         const result = await response.json();
         if (result.success) {
+            firstLastUploadId = result.upload_id;
             alert('图片上传成功！');
         } else {
             alert('上传失败：' + result.error);
@@ -302,6 +308,7 @@ async function uploadReferenceImages() {
         
         const result = await response.json();
         if (result.success) {
+            referenceUploadId = result.upload_id;
             alert('参考图上传成功！');
         } else {
             alert('上传失败：' + result.error);
@@ -329,6 +336,10 @@ async function generateFirstLastVideo() {
         formData.append('temperature', document.getElementById('firstLastTemperature').value);
     }
     
+    if (firstLastUploadId) {
+        formData.append('upload_id', firstLastUploadId);
+    }
+    
     // 添加图片文件
     if (firstFrameFile) {
         formData.append('first_frame', firstFrameFile);
@@ -380,6 +391,10 @@ async function generateReferenceVideo() {
         formData.append('temperature', document.getElementById('referenceTemperature').value);
     }
     
+    if (referenceUploadId) {
+        formData.append('upload_id', referenceUploadId);
+    }
+    
     // 添加参考图文件
     referenceFiles.forEach((file, index) => {
         formData.append('reference_images', file);
@@ -410,31 +425,34 @@ async function generateReferenceVideo() {
     }
 }
 
-// 轮询首尾帧任务状态
-async function pollFirstLastTaskStatus(taskId) {
+// 监听首尾帧任务状态：优先使用 SSE 推送，不支持时回退为轮询
+function pollFirstLastTaskStatus(taskId) {
+    if (window.EventSource) {
+        const source = new EventSource(`/events/${taskId}`);
+        source.addEventListener('status', (event) => {
+            if (handleFirstLastTaskResult(JSON.parse(event.data))) {
+                source.close();
+            }
+        });
+        source.addEventListener('done', () => source.close());
+        source.addEventListener('error', () => {
+            // 服务端拒绝连接（如 SSE 连接数已满返回 503）时不再重连，回退为轮询
+            if (source.readyState === EventSource.CLOSED) {
+                pollFirstLastTaskStatusOnce(taskId);
+            }
+        });
+        return;
+    }
+    pollFirstLastTaskStatusOnce(taskId);
+}
+
+async function pollFirstLastTaskStatusOnce(taskId) {
     try {
-        const response = await fetch(`/status/${taskId}`);
+        const response = await fetch(`/task_status/${taskId}`);
         const result = await response.json();
-        
-        document.getElementById('firstLastProgressText').textContent = `任务状态: ${result.status}`;
-        
-        if (result.status === 'completed') {
-            document.getElementById('firstLastProgressSection').style.display = 'none';
-            document.getElementById('firstLastResultSection').style.display = 'block';
-            
-            const video = document.getElementById('firstLastResultVideo');
-            const downloadLink = document.getElementById('firstLastDownloadLink');
-            
-            video.src = result.video_url;
-            video.style.display = 'block';
-            downloadLink.href = result.video_url;
-            downloadLink.style.display = 'inline-block';
-        } else if (result.status === 'failed') {
-            document.getElementById('firstLastProgressSection').style.display = 'none';
-            alert('视频生成失败：' + result.error);
-        } else {
+        if (!handleFirstLastTaskResult(result)) {
             // 继续轮询
-            setTimeout(() => pollFirstLastTaskStatus(taskId), 2000);
+            setTimeout(() => pollFirstLastTaskStatusOnce(taskId), 2000);
         }
     } catch (error) {
         document.getElementById('firstLastProgressSection').style.display = 'none';
@@ -442,31 +460,58 @@ async function pollFirstLastTaskStatus(taskId) {
     }
 }
 
-// 轮询参考图任务状态
-async function pollReferenceTaskStatus(taskId) {
-    try {
-        const response = await fetch(`/status/${taskId}`);
-        const result = await response.json();
+// 处理首尾帧任务状态，任务结束（成功/失败）时返回 true
+function handleFirstLastTaskResult(result) {
+    document.getElementById('firstLastProgressText').textContent = `任务状态: ${result.status}`;
+    
+    if (result.status === 'completed') {
+        document.getElementById('firstLastProgressSection').style.display = 'none';
+        document.getElementById('firstLastResultSection').style.display = 'block';
         
-        document.getElementById('referenceProgressText').textContent = `任务状态: ${result.status}`;
+        const video = document.getElementById('firstLastResultVideo');
+        const downloadLink = document.getElementById('firstLastDownloadLink');
         
-        if (result.status === 'completed') {
-            document.getElementById('referenceProgressSection').style.display = 'none';
-            document.getElementById('referenceResultSection').style.display = 'block';
-            
-            const video = document.getElementById('referenceResultVideo');
-            const downloadLink = document.getElementById('referenceDownloadLink');
-            
-            video.src = result.video_url;
-            video.style.display = 'block';
-            downloadLink.href = result.video_url;
-            downloadLink.style.display = 'inline-block';
-        } else if (result.status === 'failed') {
-            document.getElementById('referenceProgressSection').style.display = 'none';
-            alert('视频生成失败：' + result.error);
-        } else {
+        video.src = result.video_url;
+        video.style.display = 'block';
+        downloadLink.href = result.video_url;
+        downloadLink.style.display = 'inline-block';
+        return true;
+    } else if (result.status === 'failed') {
+        document.getElementById('firstLastProgressSection').style.display = 'none';
+        alert('视频生成失败：' + result.error);
+        return true;
+    }
+    return false;
+}
+
+// 监听参考图任务状态：优先使用 SSE 推送，不支持时回退为轮询
+function pollReferenceTaskStatus(taskId) {
+    if (window.EventSource) {
+        const source = new EventSource(`/events/${taskId}`);
+        source.addEventListener('status', (event) => {
+            if (handleReferenceTaskResult(JSON.parse(event.data))) {
+                source.close();
+            }
+        });
+        source.addEventListener('done', () => source.close());
+        source.addEventListener('error', () => {
+            // 服务端拒绝连接（如 SSE 连接数已满返回 503）时不再重连，回退为轮询
+            if (source.readyState === EventSource.CLOSED) {
+                pollReferenceTaskStatusOnce(taskId);
+            }
+        });
+        return;
+    }
+    pollReferenceTaskStatusOnce(taskId);
+}
+
+async function pollReferenceTaskStatusOnce(taskId) {
+    try {
+        const response = await fetch(`/task_status/${taskId}`);
+        const result = await response.json();
+        if (!handleReferenceTaskResult(result)) {
             // 继续轮询
-            setTimeout(() => pollReferenceTaskStatus(taskId), 2000);
+            setTimeout(() => pollReferenceTaskStatusOnce(taskId), 2000);
         }
     } catch (error) {
         document.getElementById('referenceProgressSection').style.display = 'none';
@@ -474,6 +519,30 @@ async function pollReferenceTaskStatus(taskId) {
     }
 }
 
+// 处理参考图任务状态，任务结束（成功/失败）时返回 true
+function handleReferenceTaskResult(result) {
+    document.getElementById('referenceProgressText').textContent = `任务状态: ${result.status}`;
+    
+    if (result.status === 'completed') {
+        document.getElementById('referenceProgressSection').style.display = 'none';
+        document.getElementById('referenceResultSection').style.display = 'block';
+        
+        const video = document.getElementById('referenceResultVideo');
+        const downloadLink = document.getElementById('referenceDownloadLink');
+        
+        video.src = result.video_url;
+        video.style.display = 'block';
+        downloadLink.href = result.video_url;
+        downloadLink.style.display = 'inline-block';
+        return true;
+    } else if (result.status === 'failed') {
+        document.getElementById('referenceProgressSection').style.display = 'none';
+        alert('视频生成失败：' + result.error);
+        return true;
+    }
+    return false;
+}
+
 // 页面加载完成后初始化
 document.addEventListener('DOMContentLoaded', function() {
     setupFirstLastUpload();
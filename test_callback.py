@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地替身：模拟方舟向 /callbacks/ark 推送任务状态回调
+
+用法：
+  1) 启动服务：python app.py
+  2) 运行：python test_callback.py [task_id] [video_url]
+     - task_id 为服务正在跟踪的任务时，回调会更新任务状态并触发视频下载
+     - 签名密钥与服务一致：优先取 ARK_CALLBACK_SECRET，否则由 data/signing.key 派生
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+
+import requests
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+BASE_URL = os.environ.get('APP_BASE_URL', 'http://127.0.0.1:5000')
+SIGNING_KEY_PATH = os.path.join('data', 'signing.key')
+
+
+def callback_secret():
+    """与 app.py 中 callback_secret() 保持一致"""
+    secret = os.environ.get('ARK_CALLBACK_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    signing_key = os.environ.get('SIGNED_URL_SECRET', '').encode('utf-8')
+    if not signing_key:
+        with open(SIGNING_KEY_PATH, 'rb') as f:
+            signing_key = f.read().strip()
+    return hmac.new(signing_key, b'ark-callback', hashlib.sha256).hexdigest().encode('ascii')
+
+
+def build_task_payload(task_id, status, video_url=None, created_at=None):
+    """构造与方舟任务查询响应同结构的回调体"""
+    now = int(time.time())
+    payload = {
+        'id': task_id,
+        'model': 'seedance-1-0-lite-i2v-250428',
+        'status': status,
+        'created_at': created_at or now - 60,
+        'updated_at': now,
+    }
+    if video_url:
+        payload['content'] = {'video_url': video_url}
+    return payload
+
+
+def send_callback(payload, secret=None, sign=True):
+    body = json.dumps(payload).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if sign:
+        digest = hmac.new(secret or callback_secret(), body, hashlib.sha256).hexdigest()
+        headers['X-Callback-Signature'] = f'sha256={digest}'
+    return requests.post(f"{BASE_URL}/callbacks/ark", data=body, headers=headers, timeout=10)
+
+
+def run_callback_scenarios(task_id, video_url):
+    print("🧪 Sending stand-in Ark callbacks...\n")
+    created_at = int(time.time()) - 60
+
+    # 场景1: 任务运行中
+    print("📋 Scenario 1: running")
+    try:
+        response = send_callback(build_task_payload(task_id, 'running', created_at=created_at))
+        print(f"   Status: {response.status_code}")
+        print(f"   Response: {response.text[:200]}")
+    except Exception as e:
+        print(f"   Error: {e}")
+
+    # 场景2: 任务成功，附带视频地址（服务应开始下载）
+    print("\n📋 Scenario 2: succeeded")
+    succeeded = build_task_payload(task_id, 'succeeded', video_url=video_url, created_at=created_at)
+    try:
+        response = send_callback(succeeded)
+        print(f"   Status: {response.status_code}")
+        print(f"   Response: {response.text[:200]}")
+    except Exception as e:
+        print(f"   Error: {e}")
+
+    # 场景3: 重复投递同一事件（应返回 duplicate）
+    print("\n📋 Scenario 3: duplicate delivery")
+    try:
+        response = send_callback(succeeded)
+        print(f"   Status: {response.status_code}")
+        print(f"   Response: {response.text[:200]}")
+    except Exception as e:
+        print(f"   Error: {e}")
+
+    # 场景4: 错误签名（应返回 403）
+    print("\n📋 Scenario 4: invalid signature")
+    try:
+        response = send_callback(succeeded, secret=b'wrong-secret')
+        print(f"   Status: {response.status_code}")
+        print(f"   Response: {response.text[:200]}")
+    except Exception as e:
+        print(f"   Error: {e}")
+
+    # 场景5: 无签名也无 token（应返回 403）
+    print("\n📋 Scenario 5: unsigned")
+    try:
+        response = send_callback(succeeded, sign=False)
+        print(f"   Status: {response.status_code}")
+        print(f"   Response: {response.text[:200]}")
+    except Exception as e:
+        print(f"   Error: {e}")
+
+    # 查询任务状态
+    print("\n📋 Task status after callbacks")
+    try:
+        response = requests.get(f"{BASE_URL}/task_status/{task_id}", timeout=10)
+        print(f"   Status: {response.status_code}")
+        print(f"   Response: {response.text[:200]}")
+    except Exception as e:
+        print(f"   Error: {e}")
+
+
+if __name__ == "__main__":
+    task_id = sys.argv[1] if len(sys.argv) > 1 else 'cgt-local-callback-test'
+    video_url = sys.argv[2] if len(sys.argv) > 2 else 'https://example.com/video.mp4'
+    run_callback_scenarios(task_id, video_url)
+    print("\n✅ Test completed!")